@@ -0,0 +1,189 @@
+# bench/fake_upstreams.py
+"""
+Local stand-ins for the OpenWeather (geo, zip, onecall, timemachine) and Google Places autocomplete APIs.
+
+Responses are deterministic for a given query and shaped like the real APIs, so main.py can be pointed at them
+with OPENWEATHER_BASE_URL / GOOGLE_PLACES_BASE_URL. Latency, jitter and error rate are configurable, and
+per-endpoint call counts are served at GET /__stats (POST /__reset clears them).
+
+    python -m bench.fake_upstreams --port 8900 --latency-ms 80 --error-rate 0.01
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ENDPOINTS = {
+    ("GET", "/geo/1.0/direct"): "geo",
+    ("GET", "/data/2.5/weather"): "zip",
+    ("GET", "/data/3.0/onecall"): "onecall",
+    ("GET", "/data/3.0/onecall/timemachine"): "timemachine",
+    ("POST", "/v1/places:autocomplete"): "places",
+}
+
+def _unit(text):
+    """Deterministic float in [0, 1) for a string."""
+    return int(hashlib.md5(text.encode()).hexdigest()[:8], 16) / 0x100000000
+
+def _coords(text):
+    return round(_unit("lat:" + text) * 140 - 70, 4), round(_unit("lon:" + text) * 360 - 180, 4)
+
+def geo_response(params):
+    query = params.get("q", "")
+    if query.lower().startswith("nowhere"):
+        return 200, []
+    lat, lon = _coords(query)
+    return 200, [{"name": query.split(",")[0].title(), "lat": lat, "lon": lon, "country": "US", "state": "Bench"}]
+
+def zip_response(params):
+    zip_code = params.get("zip", "")
+    if zip_code.startswith("00000"):
+        return 404, {"cod": "404", "message": "city not found"}
+    lat, lon = _coords(zip_code)
+    return 200, {"cod": 200, "coord": {"lat": lat, "lon": lon}, "name": f"Bench {zip_code.split(',')[0]}"}
+
+def _conditions(lat, lon, dt):
+    seed = f"{lat}:{lon}:{dt // 3600}"
+    return {"dt": dt, "temp": round(_unit(seed) * 40 - 5, 2), "humidity": int(_unit("h" + seed) * 100),
+            "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}]}
+
+def onecall_response(params):
+    lat, lon = float(params.get("lat", 0)), float(params.get("lon", 0))
+    now = int(time.time())
+    daily = [{**_conditions(lat, lon, now + day * 86400), "temp": {"min": 5.0, "max": 20.0}} for day in range(8)]
+    return 200, {"lat": lat, "lon": lon, "timezone": "UTC", "timezone_offset": 0,
+                 "current": _conditions(lat, lon, now), "daily": daily}
+
+def timemachine_response(params):
+    lat, lon, dt = float(params.get("lat", 0)), float(params.get("lon", 0)), int(params.get("dt", 0))
+    return 200, {"lat": lat, "lon": lon, "timezone": "UTC", "timezone_offset": 0, "data": [_conditions(lat, lon, dt)]}
+
+def places_response(body):
+    query = str(body.get("input", "")).strip()
+    if not query:
+        return 200, {}
+    count = 1 + int(_unit(query.lower()) * 5) # 1..5 predictions, so some prefixes are truncated and some aren't
+    suggestions = [{"placePrediction": {"structuredFormat": {
+        "mainText": {"text": f"{query.title()}{suffix}"}, "secondaryText": {"text": "Bench County, USA"}}}}
+        for suffix in ("", "ville", " City", "ton", " Springs")[:count]]
+    return 200, {"suggestions": suggestions}
+
+class FakeUpstreams:
+    """Runs the fake upstream server on a background thread."""
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=None):
+        self.latency_ms, self.jitter_ms, self.error_rate = latency_ms, jitter_ms, error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self._calls), "errors": dict(self._errors)}
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._errors.clear()
+
+    def _record(self, name):
+        """Counts a call and decides (delay_seconds, fail) for it."""
+        with self._lock:
+            self._calls[name] = self._calls.get(name, 0) + 1
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self._errors[name] = self._errors.get(name, 0) + 1
+        return delay, fail
+
+    def _handler_class(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real APIs
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method):
+                parts = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                if parts.path == "/__stats":
+                    return self._send_json(200, upstreams.stats())
+                if parts.path == "/__reset":
+                    upstreams.reset()
+                    return self._send_json(200, {"ok": True})
+                name = ENDPOINTS.get((method, parts.path))
+                if name is None:
+                    return self._send_json(404, {"cod": "404", "message": f"Unknown endpoint {method} {parts.path}"})
+                delay, fail = upstreams._record(name)
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    return self._send_json(503, {"cod": 503, "message": "Injected upstream error"})
+                params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                if name == "places":
+                    status, payload = places_response(json.loads(raw_body or b"{}"))
+                else:
+                    status, payload = {"geo": geo_response, "zip": zip_response, "onecall": onecall_response,
+                                       "timemachine": timemachine_response}[name](params)
+                self._send_json(status, payload)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local OpenWeather / Google Places stand-ins.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean added latency per call.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Latency is uniform in latency +/- jitter.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with a 503.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    upstreams = FakeUpstreams(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    print(f"Fake upstreams listening on {upstreams.base_url} (Ctrl+C to stop)")
+    try:
+        upstreams._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        upstreams._server.server_close()
+
+if __name__ == "__main__":
+    main()
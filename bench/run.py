@@ -0,0 +1,261 @@
+# bench/run.py
+"""
+Load-test harness for main.py against local upstream stand-ins (bench/fake_upstreams.py).
+
+Starts the fake OpenWeather / Places server, launches `uvicorn main:app` pointed at it, drives
+/api/weather/current, /api/suggest-locations and /api/db/data/* with a configurable concurrency and
+cache-hit mix, and reports p50/p95/p99 latency, RPS and upstream call counts per endpoint.
+
+By default the server uses a fresh embedded SQLite database in a temporary directory. With --db-backend mysql
+it uses whatever DB_HOST / DB_USER / DB_PASSWORD point at, with a disposable schema (DB_NAME, default
+'weather_bench'); either way the schema is migrated on startup. Never point it at a real database.
+
+    python -m bench.run --duration 30 --concurrency 50 --hit-ratio 0.9
+    python -m bench.run --write-baseline bench/baseline.json    # record this machine's baseline
+    python -m bench.run --baseline bench/baseline.json          # exit 1 on a regression beyond --tolerance
+
+Baselines are machine-specific: record one on the machine that will run the comparisons.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.fake_upstreams import FakeUpstreams
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("current", "suggest", "db_data")
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class Workload:
+    """Generates requests. With probability hit_ratio a request reuses a hot (pre-warmed) key, otherwise a new one."""
+    def __init__(self, hit_ratio, hot_keys, mix, seed):
+        self.hit_ratio = hit_ratio
+        self.mix = mix
+        self._random = random.Random(seed)
+        self.hot_locations = [self._random_location() for _ in range(hot_keys)]
+        self.hot_queries = [self._random_query() for _ in range(hot_keys)]
+
+    def _random_location(self):
+        return {"type": "gps", "lat": round(self._random.uniform(-60, 60), 4), "lon": round(self._random.uniform(-180, 180), 4)}
+
+    def _random_query(self):
+        return "".join(self._random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(self._random.randint(4, 8)))
+
+    def _hot(self):
+        return self._random.random() < self.hit_ratio
+
+    def next_request(self):
+        """Returns (scenario, method, path, json_body, params)."""
+        scenario = self._random.choices(SCENARIOS, weights=[self.mix[name] for name in SCENARIOS])[0]
+        if scenario == "current":
+            body = self._random.choice(self.hot_locations) if self._hot() else self._random_location()
+            return scenario, "POST", "/api/weather/current", body, None
+        if scenario == "suggest":
+            query = self._random.choice(self.hot_queries) if self._hot() else self._random_query()
+            return scenario, "GET", "/api/suggest-locations", None, {"query": query}
+        return scenario, "GET", "/api/db/data/weather_cache", None, {"limit": 100}
+
+    def warmup_requests(self):
+        for body in self.hot_locations:
+            yield "current", "POST", "/api/weather/current", body, None
+        for query in self.hot_queries:
+            yield "suggest", "GET", "/api/suggest-locations", None, {"query": query}
+
+async def _send(client, method, path, body, params):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=body, params=params)
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+async def drive(base_url, workload, concurrency, duration, max_requests):
+    """Runs `concurrency` closed-loop workers until duration elapses or max_requests are sent."""
+    latencies = {name: [] for name in SCENARIOS}
+    errors = {name: 0 for name in SCENARIOS}
+    sent = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        for _, method, path, body, params in workload.warmup_requests():
+            await _send(client, method, path, body, params)
+
+        deadline = time.perf_counter() + duration
+        async def worker():
+            nonlocal sent
+            while time.perf_counter() < deadline and (max_requests is None or sent < max_requests):
+                sent += 1
+                scenario, method, path, body, params = workload.next_request()
+                elapsed, ok = await _send(client, method, path, body, params)
+                latencies[scenario].append(elapsed)
+                if not ok:
+                    errors[scenario] += 1
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+    return latencies, errors, wall
+
+def summarize(latencies, errors, wall, upstream_calls):
+    endpoints = {}
+    for name, values in latencies.items():
+        if not values:
+            continue
+        values.sort()
+        endpoints[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "rps": round(len(values) / wall, 1),
+            **{f"p{p}_ms": round(percentile(values, p / 100) * 1000, 2) for p in (50, 95, 99)},
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {"wall_seconds": round(wall, 2), "requests": total, "rps": round(total / wall, 1) if wall else 0,
+            "endpoints": endpoints, "upstream_calls": upstream_calls}
+
+def compare(results, baseline, tolerance):
+    """Returns regression messages: p95/p99 up, or RPS down, by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if previous.get(key) and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {current[key]} vs baseline {previous[key]}")
+        if previous.get("rps") and current["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{name} rps: {current['rps']} vs baseline {previous['rps']}")
+    return regressions
+
+def start_server(port, upstream_url, db_backend, sqlite_path, extra_env):
+    env = {
+        **os.environ,
+        "OPENWEATHER_BASE_URL": upstream_url,
+        "GOOGLE_PLACES_BASE_URL": upstream_url,
+        "OPENWEATHER_API_KEY": "bench",
+        "GOOGLE_PLACES_API_KEY": "bench",
+        "DB_BACKEND": db_backend,
+        "SQLITE_PATH": sqlite_path,
+        "DB_NAME": os.getenv("DB_NAME", "weather_bench"),
+        "DB_AUTO_MIGRATE": "1",
+        "PREWARM_ENABLED": "0",
+        "RETENTION_INTERVAL_SECONDS": "0",
+        "OPENWEATHER_RATE_PER_MINUTE": "0", # Measure the app, not the local token bucket; override with --env
+        "GOOGLE_PLACES_RATE_PER_MINUTE": "0",
+        **extra_env,
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, env=env,
+    )
+
+def wait_until_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {process.returncode} during startup.")
+        try:
+            if httpx.get(f"{base_url}/api/metrics", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become ready within {timeout}s.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against local upstream stand-ins.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of measured load (after warm-up).")
+    parser.add_argument("--requests", type=int, default=None, help="Stop after this many requests instead.")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--hit-ratio", type=float, default=0.9, help="Fraction of requests reusing a pre-warmed key.")
+    parser.add_argument("--hot-keys", type=int, default=50, help="Number of pre-warmed locations / queries.")
+    parser.add_argument("--mix", default="current=0.7,suggest=0.25,db_data=0.05", help="Scenario weights.")
+    parser.add_argument("--upstream-latency-ms", type=float, default=50)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=10)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--base-url", default=None, help="Benchmark an already running server instead of starting one.")
+    parser.add_argument("--db-backend", choices=("sqlite", "mysql"), default="sqlite")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra env for the server (repeatable).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Also write the results JSON here.")
+    parser.add_argument("--baseline", default=None, help="Compare against this baseline file.")
+    parser.add_argument("--write-baseline", default=None, help="Write the results to this baseline file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression vs the baseline (fraction).")
+    args = parser.parse_args()
+
+    mix = {name: 0.0 for name in SCENARIOS}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in mix:
+            parser.error(f"Unknown scenario '{name}' in --mix (expected {', '.join(SCENARIOS)}).")
+        mix[name.strip()] = float(weight)
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    upstreams = FakeUpstreams(latency_ms=args.upstream_latency_ms, jitter_ms=args.upstream_jitter_ms,
+                              error_rate=args.upstream_error_rate, seed=args.seed).start()
+    process = None
+    base_url = args.base_url
+    db_dir = tempfile.TemporaryDirectory(prefix="weather-bench-")
+    try:
+        if base_url is None:
+            base_url = f"http://127.0.0.1:{args.port}"
+            sqlite_path = os.path.join(db_dir.name, "bench.sqlite3")
+            process = start_server(args.port, upstreams.base_url, args.db_backend, sqlite_path, extra_env)
+            wait_until_ready(base_url, process)
+        workload = Workload(args.hit_ratio, args.hot_keys, mix, args.seed)
+        latencies, errors, wall = asyncio.run(drive(base_url, workload, args.concurrency, args.duration, args.requests))
+        upstream_calls = upstreams.stats()["calls"] # Includes warm-up calls
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        upstreams.stop()
+        db_dir.cleanup()
+
+    results = summarize(latencies, errors, wall, upstream_calls)
+    results["config"] = {key: getattr(args, key) for key in ("duration", "requests", "concurrency", "hit_ratio", "hot_keys", "db_backend",
+                         "upstream_latency_ms", "upstream_jitter_ms", "upstream_error_rate", "seed")}
+    results["config"]["mix"] = mix
+
+    print(f"{'endpoint':<10} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, row in results["endpoints"].items():
+        print(f"{name:<10} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+    print(f"total: {results['requests']} requests in {results['wall_seconds']}s ({results['rps']} rps)")
+    print(f"upstream calls: {json.dumps(upstream_calls, sort_keys=True)}")
+
+    for path in filter(None, (args.output, args.write_baseline)):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Wrote {path}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was recorded with a different configuration; comparison may not be meaningful.")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions vs baseline:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print(f"No regressions vs baseline (tolerance {args.tolerance:.0%}).")
+
+if __name__ == "__main__":
+    main()
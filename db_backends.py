@@ -0,0 +1,368 @@
+# db_backends.py
+"""
+Storage backends for db_cache: MySQL (pymysql) and embedded SQLite in WAL mode.
+
+db_cache writes its queries in the MySQL dialect with %s placeholders, which SQLite also understands for
+everything it uses (REPLACE INTO, LIMIT offset, count, backquoted identifiers) once placeholders are converted.
+Everything that genuinely differs (catalog queries, INSERT IGNORE, row-value IN lists, named locks,
+table stats, database creation) goes through the backend db_cache selects with DB_BACKEND.
+"""
+import functools
+import hashlib
+import os
+import re
+import threading
+import time
+
+class MySQLBackend:
+    name = "mysql"
+
+    def __init__(self, host, user, password, database, max_lock_connections=32):
+        import pymysql # Imported lazily so SQLite deployments don't need the driver
+        self._pymysql = pymysql
+        self.host, self.user, self.password, self.database = host, user, password, database
+        self._lock_slots = threading.BoundedSemaphore(max(1, max_lock_connections)) # Dedicated lock connections open at once
+        self.Error = pymysql.Error
+        self.OperationalError = pymysql.err.OperationalError
+        self.UndefinedTableError = pymysql.err.ProgrammingError
+
+    def connect(self):
+        return self._pymysql.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            charset='utf8mb4',
+            cursorclass=self._pymysql.cursors.DictCursor
+        )
+
+    def ensure_database(self):
+        temp_conn = self._pymysql.connect(
+            host=self.host, user=self.user, password=self.password,
+            charset='utf8mb4', cursorclass=self._pymysql.cursors.DictCursor
+        )
+        try:
+            with temp_conn.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{self.database}`")
+            temp_conn.commit()
+            print(f"Database '{self.database}' ensured to exist.")
+        finally:
+            temp_conn.close()
+
+    def streaming_cursor(self, conn):
+        """Unbuffered cursor: rows are read from the server as they are iterated."""
+        return conn.cursor(self._pymysql.cursors.SSDictCursor)
+
+    # SQL dialect
+
+    def insert_ignore(self):
+        return "INSERT IGNORE INTO"
+
+    def row_in(self, columns, count):
+        """`(c1, c2) IN (...)` condition matching any of `count` value tuples."""
+        row = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        return f"({', '.join(columns)}) IN ({', '.join([row] * count)})"
+
+    # Catalog
+
+    def list_tables(self, cursor):
+        cursor.execute("SHOW TABLES;")
+        # When using DictCursor, 'SHOW TABLES' returns a dictionary
+        # with a key like 'Tables_in_<DB_NAME>'.
+        return [row['Tables_in_' + self.database] for row in cursor.fetchall()]
+
+    def describe_columns(self, cursor, table_name):
+        cursor.execute(f"DESCRIBE `{table_name}`;")
+        return [row['Field'] for row in cursor.fetchall()]
+
+    def primary_key_columns(self, cursor, table_name):
+        cursor.execute("""
+            SELECT COLUMN_NAME
+            FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY'
+            ORDER BY ORDINAL_POSITION;
+        """, (self.database, table_name))
+        return [row['COLUMN_NAME'] for row in cursor.fetchall()]
+
+    def column_exists(self, cursor, table_name, column_name):
+        cursor.execute("""
+            SELECT COUNT(*) AS n FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        """, (self.database, table_name, column_name))
+        return cursor.fetchone()['n'] > 0
+
+    def index_exists(self, cursor, table_name, index_name):
+        cursor.execute("""
+            SELECT COUNT(*) AS n FROM INFORMATION_SCHEMA.STATISTICS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s
+        """, (self.database, table_name, index_name))
+        return cursor.fetchone()['n'] > 0
+
+    def table_stats(self, cursor):
+        cursor.execute("""
+            SELECT TABLE_NAME AS table_name, TABLE_ROWS AS approx_rows,
+                   DATA_LENGTH AS data_bytes, INDEX_LENGTH AS index_bytes
+            FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = %s
+            ORDER BY TABLE_NAME
+        """, (self.database,))
+        return cursor.fetchall()
+
+    # Named locks
+
+    def lock_name(self, name):
+        # MySQL lock names are limited to 64 characters and are server-wide, so namespace by database.
+        full_name = f"{self.database}:{name}"
+        return full_name if len(full_name) <= 64 else hashlib.sha1(full_name.encode()).hexdigest()
+
+    def acquire_lock(self, name, timeout):
+        """
+        GET_LOCK on a dedicated connection outside the pool, so a held lock never takes a pooled connection away
+        from other requests. Returns the connection holding the lock, or None if it (or a free lock slot) timed out.
+        """
+        deadline = time.monotonic() + timeout
+        if not self._lock_slots.acquire(timeout=timeout):
+            return None
+        try:
+            conn = self.connect()
+        except Exception:
+            self._lock_slots.release()
+            raise
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, %s) AS acquired", (self.lock_name(name), max(0, round(deadline - time.monotonic()))))
+                row = cursor.fetchone()
+        except Exception:
+            self._close_lock_connection(conn)
+            raise
+        if row and row['acquired'] == 1:
+            return conn
+        self._close_lock_connection(conn)
+        return None
+
+    def release_lock(self, handle, name):
+        try:
+            with handle.cursor() as cursor:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (self.lock_name(name),))
+        except Exception as e:
+            print(f"Error releasing advisory lock '{name}': {e}") # Closing the session below drops the lock anyway
+        finally:
+            self._close_lock_connection(handle)
+
+    def _close_lock_connection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        finally:
+            self._lock_slots.release()
+
+@functools.lru_cache(maxsize=512)
+def _to_qmark(sql):
+    """Converts pymysql-style %s placeholders (and %% escapes) to sqlite3's qmark style."""
+    return re.sub(r"%([s%])", lambda m: "?" if m.group(1) == "s" else "%", sql)
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+class SQLiteCursor:
+    """sqlite3 cursor with the pymysql DictCursor interface used by db_cache (%s params, dict rows, context manager)."""
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=None):
+        if params is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(_to_qmark(sql), tuple(params))
+        return self._cursor.rowcount
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(_to_qmark(sql), [tuple(params) for params in seq_of_params])
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class SQLiteConnection:
+    """sqlite3 connection with the subset of the pymysql connection interface that db_cache and its pool use."""
+    def __init__(self, raw_conn):
+        self._conn = raw_conn
+
+    def cursor(self, cursor_class=None):
+        return SQLiteCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self, reconnect=False):
+        self._conn.execute("SELECT 1")
+
+    def close(self):
+        self._conn.close()
+
+class SQLiteBackend:
+    """
+    Embedded SQLite in WAL mode: readers never block the writer, and cache hits are served from local disk.
+    Named locks are file locks next to the database, so they coordinate the workers of one host.
+    """
+    name = "sqlite"
+
+    def __init__(self, path, busy_timeout_seconds=5.0, mmap_bytes=0):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.path = path
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.mmap_bytes = mmap_bytes
+        self.Error = sqlite3.Error
+        self.OperationalError = sqlite3.OperationalError
+        self.UndefinedTableError = sqlite3.OperationalError # "no such table"
+
+    def connect(self):
+        raw_conn = self._sqlite3.connect(self.path, timeout=self.busy_timeout_seconds, check_same_thread=False) # The pool hands a connection to one thread at a time
+        raw_conn.row_factory = _dict_row
+        raw_conn.execute("PRAGMA journal_mode=WAL")
+        raw_conn.execute("PRAGMA synchronous=NORMAL") # Durable across application crashes; a cache can afford losing the last commits on power loss
+        if self.mmap_bytes:
+            raw_conn.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+        return SQLiteConnection(raw_conn)
+
+    def ensure_database(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        print(f"SQLite database '{self.path}' ensured to exist.")
+
+    def streaming_cursor(self, conn):
+        return conn.cursor() # sqlite3 cursors already step through results lazily
+
+    # SQL dialect
+
+    def insert_ignore(self):
+        return "INSERT OR IGNORE INTO"
+
+    def row_in(self, columns, count):
+        row = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        return f"({', '.join(columns)}) IN (VALUES {', '.join([row] * count)})"
+
+    # Catalog
+
+    @staticmethod
+    def _quote(identifier):
+        return '"' + str(identifier).replace('"', '""') + '"'
+
+    def list_tables(self, cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        return [row['name'] for row in cursor.fetchall()]
+
+    def _table_info(self, cursor, table_name):
+        cursor.execute(f"PRAGMA table_info({self._quote(table_name)})")
+        rows = cursor.fetchall()
+        if not rows:
+            raise self.OperationalError(f"no such table: {table_name}") # DESCRIBE fails the same way on MySQL
+        return rows
+
+    def describe_columns(self, cursor, table_name):
+        return [row['name'] for row in self._table_info(cursor, table_name)]
+
+    def primary_key_columns(self, cursor, table_name):
+        return [row['name'] for row in sorted(self._table_info(cursor, table_name), key=lambda r: r['pk']) if row['pk']]
+
+    def column_exists(self, cursor, table_name, column_name):
+        cursor.execute(f"PRAGMA table_info({self._quote(table_name)})")
+        return any(row['name'] == column_name for row in cursor.fetchall())
+
+    def index_exists(self, cursor, table_name, index_name):
+        cursor.execute("SELECT COUNT(*) AS n FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+                       (table_name, index_name))
+        return cursor.fetchone()['n'] > 0
+
+    def table_stats(self, cursor):
+        """Exact row counts; page sizes come from the dbstat table when SQLite was built with it (else None)."""
+        sizes = None
+        try:
+            cursor.execute("""
+                SELECT m.tbl_name AS table_name, m.type AS type, SUM(s.pgsize) AS bytes
+                FROM dbstat s JOIN sqlite_master m ON m.name = s.name
+                GROUP BY m.tbl_name, m.type
+            """)
+            sizes = {(row['table_name'], row['type']): row['bytes'] for row in cursor.fetchall()}
+        except self.OperationalError:
+            pass
+        stats = []
+        for table_name in self.list_tables(cursor):
+            cursor.execute(f"SELECT COUNT(*) AS n FROM {self._quote(table_name)}")
+            stats.append({
+                "table_name": table_name,
+                "approx_rows": cursor.fetchone()['n'],
+                "data_bytes": sizes.get((table_name, 'table'), 0) if sizes is not None else None,
+                "index_bytes": sizes.get((table_name, 'index'), 0) if sizes is not None else None,
+            })
+        return stats
+
+    # Named locks
+
+    def lock_name(self, name):
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        return safe if len(safe) <= 64 else hashlib.sha1(name.encode()).hexdigest()
+
+    def acquire_lock(self, name, timeout):
+        """
+        flock on `<db path>.<name>.lock`. Returns the open lock file, or None if it timed out.
+        The file only exists while the lock is held (release_lock removes it), so distinct names don't pile up files.
+        """
+        import fcntl
+        path = f"{self.path}.{self.lock_name(name)}.lock"
+        deadline = time.monotonic() + timeout
+        while True:
+            lock_file = open(path, "a+")
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            lock_file.close()
+                            return None
+                        time.sleep(0.05)
+                # The previous holder may have removed the file after we opened it; then we locked an orphan.
+                if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path)):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def release_lock(self, handle, name):
+        import fcntl
+        try:
+            os.unlink(handle.name) # While still holding the lock; waiters that opened the old file will retry
+            fcntl.flock(handle, fcntl.LOCK_UN)
+        except OSError as e:
+            print(f"Error releasing advisory lock '{name}': {e}")
+        finally:
+            handle.close() # Closing the file drops the lock either way
@@ -1,148 +1,433 @@
 # db_cache.py
-import pymysql
 import json
 import time
 import os
+import base64
+import gzip
+import hashlib
+import threading
+from collections import deque
 from datetime import datetime, date, timedelta # Import timedelta for date range iteration
 
 from dotenv import load_dotenv
 
+import db_backends
+from utils import metrics
+from utils.lru_cache import TTLCache
+from utils.geo import geohash_encode, geohash_center, geohash_neighbors, haversine_km
+
 load_dotenv()
 
+# Storage backend (see db_backends.py):
+#   mysql  - MySQL server at DB_HOST / DB_NAME
+#   sqlite - embedded SQLite database file at SQLITE_PATH (WAL mode), for single-node / edge deployments
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
 DB_HOST = os.getenv("DB_HOST")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "weather_cache.sqlite3")
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", "5")) # Wait for a concurrent writer before failing
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024))) # Memory-mapped reads; 0 disables
 
 CACHE_DURATION_SECONDS = 43200 # 12 hrs
+# How long past CACHE_DURATION_SECONDS an entry may still be served while it is refreshed in the background (0 disables)
+CACHE_STALE_SECONDS = int(os.getenv("CACHE_STALE_SECONDS", str(6 * 3600)))
+
+# Connection pool settings
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+DB_POOL_IDLE_SECONDS = int(os.getenv("DB_POOL_IDLE_SECONDS", "300")) # Close idle connections above min size after this
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "3600")) # Replace connections older than this
+DB_POOL_PING_SECONDS = int(os.getenv("DB_POOL_PING_SECONDS", "30")) # Ping connections idle longer than this before reuse
+
+ADVISORY_LOCK_TIMEOUT_SECONDS = int(os.getenv("ADVISORY_LOCK_TIMEOUT_SECONDS", "10"))
+ADVISORY_LOCK_MAX_CONNECTIONS = int(os.getenv("ADVISORY_LOCK_MAX_CONNECTIONS", "32")) # MySQL: locks held at once per worker, each on its own connection
+
+# Apply pending schema migrations at startup instead of failing (convenient for development; in production run
+# `python db_migrations.py` before rolling out new workers)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0").lower() in ("1", "true", "yes")
+
+# In-process (L1) cache in front of weather_cache. Entries never outlive CACHE_DURATION_SECONDS;
+# L1_CACHE_TTL_SECONDS bounds how long other workers can serve a row changed through this one.
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", "1024"))
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+L1_CACHE_TTL_SECONDS = int(os.getenv("L1_CACHE_TTL_SECONDS", "300"))
+
+# Spatial quantization of weather_cache keys:
+#   exact   - store and match coordinates as given
+#   grid    - snap to a WEATHER_CACHE_GRID_DEGREES grid
+#   geohash - snap to the centre of the WEATHER_CACHE_GEOHASH_PRECISION geohash cell and match on the geohash column
+# In grid/geohash mode a miss falls back to the nearest fresh row in the surrounding geohash cells.
+WEATHER_CACHE_SPATIAL_MODE = os.getenv("WEATHER_CACHE_SPATIAL_MODE", "exact").lower()
+WEATHER_CACHE_GRID_DEGREES = float(os.getenv("WEATHER_CACHE_GRID_DEGREES", "0.01"))
+WEATHER_CACHE_GEOHASH_PRECISION = int(os.getenv("WEATHER_CACHE_GEOHASH_PRECISION", "6"))
+WEATHER_CACHE_NEAREST_MAX_KM = float(os.getenv("WEATHER_CACHE_NEAREST_MAX_KM", "3"))
+
+# Payload storage for weather_cache:
+#   json - JSON text in the `data` column
+#   gzip - gzip-compressed JSON bytes in `data_gz` (`data` left NULL); hits can be sent to clients without decoding
+WEATHER_CACHE_STORAGE = os.getenv("WEATHER_CACHE_STORAGE", "json").lower()
+WEATHER_CACHE_GZIP_LEVEL = int(os.getenv("WEATHER_CACHE_GZIP_LEVEL", "6"))
+
+# Retention for weather_cache: rows fetched more than WEATHER_CACHE_RETENTION_SECONDS ago are purged, and each
+# lat/lon cell keeps at most WEATHER_CACHE_KEEP_LATEST rows of each kind (newest data_ts first), so current snapshots
+# don't push out cached history days. 0 disables either rule.
+WEATHER_CACHE_RETENTION_SECONDS = int(os.getenv("WEATHER_CACHE_RETENTION_SECONDS", str(30 * 86400)))
+WEATHER_CACHE_KEEP_LATEST = int(os.getenv("WEATHER_CACHE_KEEP_LATEST", "0"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000")) # Rows deleted per transaction
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.1"))
+
+# Write-behind logging for user_queries
+QUERY_LOG_FLUSH_SIZE = int(os.getenv("QUERY_LOG_FLUSH_SIZE", "200"))
+QUERY_LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_INTERVAL_SECONDS", "2"))
+QUERY_LOG_MAX_BUFFER = int(os.getenv("QUERY_LOG_MAX_BUFFER", "10000"))
+QUERY_LOG_OVERFLOW_POLICY = os.getenv("QUERY_LOG_OVERFLOW_POLICY", "drop").lower() # drop | block
+QUERY_LOG_BLOCK_TIMEOUT_SECONDS = float(os.getenv("QUERY_LOG_BLOCK_TIMEOUT_SECONDS", "1"))
+
+# Geocode cache (city / zip -> coordinates), persisted in geocode_cache with an in-process tier in front
+GEOCODE_CACHE_DURATION_SECONDS = int(os.getenv("GEOCODE_CACHE_DURATION_SECONDS", str(30 * 86400)))
+GEOCODE_NEGATIVE_CACHE_DURATION_SECONDS = int(os.getenv("GEOCODE_NEGATIVE_CACHE_DURATION_SECONDS", "86400"))
+GEOCODE_L1_MAX_ENTRIES = int(os.getenv("GEOCODE_L1_MAX_ENTRIES", "10000"))
+
+if DB_BACKEND == 'sqlite':
+    backend = db_backends.SQLiteBackend(SQLITE_PATH, busy_timeout_seconds=SQLITE_BUSY_TIMEOUT_SECONDS, mmap_bytes=SQLITE_MMAP_BYTES)
+elif DB_BACKEND == 'mysql':
+    backend = db_backends.MySQLBackend(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, max_lock_connections=ADVISORY_LOCK_MAX_CONNECTIONS)
+else:
+    raise ValueError(f"Unknown DB_BACKEND '{DB_BACKEND}' (expected 'mysql' or 'sqlite').")
+
+class PoolTimeoutError(backend.OperationalError):
+    """Raised when no pooled connection becomes available within DB_POOL_TIMEOUT_SECONDS."""
+
+def _open_connection():
+    return backend.connect()
+
+class PooledConnection:
+    """
+    Wraps a backend connection checked out from the pool.
+    Using it as a context manager (`with get_db_connection() as conn:`) returns it to the pool
+    on exit instead of closing it; all other attributes are delegated to the real connection.
+    """
+    def __init__(self, pool, raw_conn, created_ts):
+        self._pool = pool
+        self._conn = raw_conn
+        self.created_ts = created_ts
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Returns the connection to the pool. Safe to call more than once."""
+        if self._conn is not None:
+            raw_conn, self._conn = self._conn, None
+            self._pool.release(raw_conn, self.created_ts)
+
+    def discard(self):
+        """Closes the underlying connection instead of returning it (e.g. when session state can't be reset)."""
+        if self._conn is not None:
+            raw_conn, self._conn = self._conn, None
+            self._pool.release(raw_conn, self.created_ts, discard=True)
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of database connections with health checks and idle recycling."""
+    def __init__(self, connect, min_size, max_size, timeout, idle_seconds, recycle_seconds, ping_seconds):
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.idle_seconds = idle_seconds
+        self.recycle_seconds = recycle_seconds
+        self.ping_seconds = ping_seconds
+        self._idle = deque() # (raw_conn, created_ts, last_used_ts), most recently used on the right
+        self._cond = threading.Condition()
+        self._size = 0 # Open connections, idle + checked out
+        self._checked_out = 0
+        self._waiting = 0
+        self._created = 0
+        self._closed = 0
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                self._prune_idle_locked()
+                if self._idle:
+                    raw_conn, created_ts, last_used_ts = self._idle.pop()
+                    self._checked_out += 1
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    self._checked_out += 1
+                    raw_conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"Timed out after {self.timeout}s waiting for a database connection (pool size {self.max_size}).")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        # Connect / health-check outside the lock so a slow handshake doesn't block other threads.
+        try:
+            if raw_conn is not None and not self._is_healthy(raw_conn, created_ts, last_used_ts):
+                self._close_raw(raw_conn)
+                raw_conn = None
+            if raw_conn is None:
+                raw_conn = self._connect()
+                created_ts = time.monotonic()
+                with self._cond:
+                    self._created += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.monotonic() - start)
+        return PooledConnection(self, raw_conn, created_ts)
+
+    def release(self, raw_conn, created_ts, discard=False):
+        if not discard:
+            try:
+                # End any open transaction so the next borrower doesn't see a stale REPEATABLE READ snapshot.
+                raw_conn.rollback()
+            except Exception:
+                discard = True
+        if time.monotonic() - created_ts > self.recycle_seconds:
+            discard = True
+        if discard:
+            self._close_raw(raw_conn)
+        with self._cond:
+            self._checked_out -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((raw_conn, created_ts, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "checked_out": self._checked_out,
+                "waiting": self._waiting,
+                "created": self._created,
+                "closed": self._closed,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for raw_conn, _, _ in idle:
+            self._close_raw(raw_conn)
+
+    def _is_healthy(self, raw_conn, created_ts, last_used_ts):
+        now = time.monotonic()
+        if now - created_ts > self.recycle_seconds:
+            return False
+        if now - last_used_ts > self.ping_seconds:
+            try:
+                raw_conn.ping(reconnect=False)
+            except Exception:
+                return False
+        return True
+
+    def _prune_idle_locked(self):
+        """Closes connections idle longer than idle_seconds while keeping at least min_size open."""
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][2] > self.idle_seconds:
+            raw_conn, _, _ = self._idle.popleft()
+            self._size -= 1
+            self._close_raw(raw_conn)
+
+    def _close_raw(self, raw_conn):
+        try:
+            raw_conn.close()
+        except Exception:
+            pass
+        self._closed += 1
+
+_pool = ConnectionPool(
+    _open_connection,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT_SECONDS,
+    idle_seconds=DB_POOL_IDLE_SECONDS,
+    recycle_seconds=DB_POOL_RECYCLE_SECONDS,
+    ping_seconds=DB_POOL_PING_SECONDS,
+)
+
+_weather_l1 = TTLCache(L1_CACHE_MAX_ENTRIES, max_bytes=L1_CACHE_MAX_BYTES)
+_geocode_l1 = TTLCache(GEOCODE_L1_MAX_ENTRIES)
 
 def get_db_connection():
-    return pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        charset='utf8mb4',
-        cursorclass=pymysql.cursors.DictCursor
-    )
+    """Checks out a pooled connection. Use as `with get_db_connection() as conn:` to return it to the pool."""
+    return _pool.acquire()
+
+def get_pool_stats():
+    """Returns connection pool counters (size, idle, checked_out, waiting, created, closed)."""
+    return _pool.stats()
+
+def close_pool():
+    """Closes all idle pooled connections (e.g. on application shutdown)."""
+    _pool.close_all()
+
+def get_l1_cache_stats():
+    """Returns in-process weather cache counters (entries, bytes, hits, misses, evictions, expirations)."""
+    return _weather_l1.stats()
+
+def _invalidate_weather_l1(pk_dict=None):
+    """Drops L1 entries for the lat/lon in pk_dict, or everything if the row can't be identified."""
+    try:
+        lat, lon = float(pk_dict['lat']), float(pk_dict['lon'])
+        _weather_l1.delete(("current", lat, lon))
+        _weather_l1.delete(("payload", lat, lon))
+    except (TypeError, KeyError, ValueError):
+        _weather_l1.clear()
+
+def _invalidate_weather_l1_for_edit(pk_dict):
+    """
+    Drops the L1 entries an admin edit or delete of a weather_cache row can affect. Outside exact mode the
+    nearest-row fallback may have cached this row under neighbouring cells' keys too, so everything is dropped.
+    """
+    _invalidate_weather_l1(pk_dict if WEATHER_CACHE_SPATIAL_MODE == 'exact' else None)
+
+def acquire_advisory_lock(name, timeout=ADVISORY_LOCK_TIMEOUT_SECONDS):
+    """
+    Takes a named lock shared by every worker using this database (GET_LOCK on MySQL, a file lock on SQLite).
+    Blocks for up to `timeout` seconds. Returns a handle holding the lock, or None if it timed out.
+    The lock must be released with release_advisory_lock(handle, name). Holding a lock never uses a pooled connection.
+    """
+    return backend.acquire_lock(name, timeout)
+
+def release_advisory_lock(handle, name):
+    """Releases a lock taken with acquire_advisory_lock."""
+    backend.release_lock(handle, name)
 
 def init_db():
-    # Add this block at the START of init_db()
+    """
+    Verifies the schema version at startup with a single query. Schema changes are applied by
+    `python db_migrations.py`, or here when DB_AUTO_MIGRATE is enabled.
+    """
+    import db_migrations # Imported lazily: db_migrations depends on this module
+
     try:
-        temp_conn = pymysql.connect(
-            host=DB_HOST, user=DB_USER, password=DB_PASSWORD,
-            charset='utf8mb4', cursorclass=pymysql.cursors.DictCursor
+        version = db_migrations.get_schema_version()
+    except backend.OperationalError as e:
+        if not DB_AUTO_MIGRATE:
+            raise RuntimeError(f"Cannot read schema version ({e}). Run `python db_migrations.py` or set DB_AUTO_MIGRATE=1.") from e
+        version = 0 # Most likely the database itself doesn't exist yet
+    if version >= db_migrations.LATEST_SCHEMA_VERSION:
+        return
+    if not DB_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {db_migrations.LATEST_SCHEMA_VERSION}. "
+            "Run `python db_migrations.py` or set DB_AUTO_MIGRATE=1."
         )
-        with temp_conn.cursor() as cursor:
-            cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{DB_NAME}`")
-            temp_conn.commit()
-            print(f"Database '{DB_NAME}' ensured to exist.")
-        temp_conn.close()
-    except pymysql.err.OperationalError as e:
-        print(f"Error creating database: {e}")
-        raise # Critical error, cannot proceed
+    db_migrations.migrate()
 
+def snap_coordinates(lat, lon):
+    """Quantizes coordinates according to WEATHER_CACHE_SPATIAL_MODE so nearby requests share cache rows."""
+    if lat is None or lon is None or WEATHER_CACHE_SPATIAL_MODE == 'exact':
+        return lat, lon
+    if WEATHER_CACHE_SPATIAL_MODE == 'geohash':
+        lat, lon = geohash_center(geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION))
+    else:
+        lat = round(lat / WEATHER_CACHE_GRID_DEGREES) * WEATHER_CACHE_GRID_DEGREES
+        lon = round(lon / WEATHER_CACHE_GRID_DEGREES) * WEATHER_CACHE_GRID_DEGREES
+    # Rounding keeps the stored REAL values identical for every request in the same cell
+    return round(lat, 6), round(lon, 6)
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            table_name = "weather_cache"
-
-            create_weather_cache_sql = f'''
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    lat REAL NOT NULL,
-                    lon REAL NOT NULL,
-                    data_ts INTEGER NOT NULL,
-                    fetch_ts INTEGER NOT NULL,
-                    loc VARCHAR(255),
-                    data TEXT,
-                    PRIMARY KEY (lat, lon, data_ts)
-                )
-            '''
-            cursor.execute(create_weather_cache_sql)
-            conn.commit()
+def _nearest_fresh_row(cursor, lat, lon, min_fetch_ts):
+    """Finds the closest fresh row in the geohash cell around (lat, lon) or its neighbours, within WEATHER_CACHE_NEAREST_MAX_KM."""
+    cells = geohash_neighbors(geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION))
+    placeholders = ", ".join(["%s"] * len(cells))
+    cursor.execute(f"""
+        SELECT lat, lon, data_ts, fetch_ts FROM weather_cache
+        WHERE geohash IN ({placeholders}) AND kind = 'current' AND fetch_ts > %s
+    """, (*cells, min_fetch_ts))
+    candidates = [
+        (haversine_km(lat, lon, row['lat'], row['lon']), -row['fetch_ts'], row)
+        for row in cursor.fetchall()
+    ]
+    candidates = [c for c in candidates if c[0] <= WEATHER_CACHE_NEAREST_MAX_KM]
+    if not candidates:
+        return None
+    _, _, best = min(candidates, key=lambda c: (c[0], c[1])) # Closest cell first, then the newest fetch
+    cursor.execute("""
+        SELECT data, data_gz, fetch_ts FROM weather_cache
+        WHERE lat = %s AND lon = %s AND data_ts = %s
+    """, (best['lat'], best['lon'], best['data_ts']))
+    return cursor.fetchone()
 
-            try:
-                cursor.execute(f"SELECT data_ts FROM {table_name} LIMIT 1")
-            except pymysql.err.ProgrammingError:
-                print(f"Adding 'data_ts' column to {table_name}...")
-                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN data_ts INTEGER;")
-                conn.commit()
+def _encode_payload(data):
+    """Returns (data, data_gz) column values for a payload according to WEATHER_CACHE_STORAGE."""
+    if WEATHER_CACHE_STORAGE == 'gzip':
+        return None, gzip.compress(json.dumps(data, separators=(',', ':')).encode(), compresslevel=WEATHER_CACHE_GZIP_LEVEL)
+    return json.dumps(data), None
 
-            try:
-                cursor.execute(f"SELECT fetch_ts FROM {table_name} LIMIT 1")
-            except pymysql.err.ProgrammingError:
-                print(f"Adding 'fetch_ts' column to {table_name}...")
-                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN fetch_ts INTEGER;")
-                conn.commit()
-
-            print(f"Updating NULL data_ts values in {table_name}...")
-            cursor.execute(f"UPDATE {table_name} SET data_ts = 0 WHERE data_ts IS NULL;")
-            conn.commit()
+def _payload_json(row):
+    """Returns a row's payload as JSON text (bytes for compressed rows)."""
+    if row.get('data_gz') is not None:
+        return gzip.decompress(row['data_gz'])
+    return row['data']
 
-            print(f"Updating NULL fetch_ts values in {table_name}...")
-            cursor.execute(f"UPDATE {table_name} SET fetch_ts = %s WHERE fetch_ts IS NULL;", (int(time.time()),))
-            conn.commit()
+def _decode_payload(row):
+    return json.loads(_payload_json(row))
 
-            try:
-                print(f"Setting data_ts and fetch_ts to NOT NULL in {table_name}...")
-                cursor.execute(f"ALTER TABLE {table_name} MODIFY COLUMN data_ts INTEGER NOT NULL;")
-                cursor.execute(f"ALTER TABLE {table_name} MODIFY COLUMN fetch_ts INTEGER NOT NULL;")
-                conn.commit()
-            except pymysql.err.OperationalError as e:
-                if "Invalid use of NULL value" in str(e):
-                    print(f"WARNING: 'data_ts' or 'fetch_ts' still has NULLs despite UPDATE. Please manually verify table data. Error: {e}")
-                elif "Duplicate column name" not in str(e):
-                    raise
-            
-            cursor.execute(f"""
-                SELECT COLUMN_NAME
-                FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
-                WHERE TABLE_SCHEMA = '{DB_NAME}' AND TABLE_NAME = '{table_name}' AND CONSTRAINT_NAME = 'PRIMARY'
-                ORDER BY ORDINAL_POSITION;
-            """)
-            current_pk_columns = [row['COLUMN_NAME'] for row in cursor.fetchall()]
-            required_pk_columns = ['lat', 'lon', 'data_ts']
-
-            if sorted(current_pk_columns) != sorted(required_pk_columns):
-                print(f"Primary key needs update for {table_name}. Current: {current_pk_columns}, Required: {required_pk_columns}")
-                if current_pk_columns:
-                    print(f"Dropping existing primary key from {table_name}...")
-                    try:
-                        cursor.execute(f"ALTER TABLE {table_name} DROP PRIMARY KEY;")
-                        conn.commit()
-                    except pymysql.err.OperationalError as drop_e:
-                        print(f"WARNING: Failed to drop existing primary key. Error: {drop_e}")
-                
-                print(f"Adding new primary key (lat, lon, data_ts) to {table_name}...")
-                try:
-                    cursor.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (lat, lon, data_ts);")
-                    conn.commit()
-                except pymysql.err.OperationalError as add_pk_e:
-                    print(f"CRITICAL: Failed to add primary key (lat, lon, data_ts) to {table_name}. Error: {add_pk_e}")
-                    print("This usually means duplicate (lat, lon, data_ts) entries exist in your data, or NULL values are still present.")
-                    raise
-            else:
-                print(f"Primary key for {table_name} is already correct ({current_pk_columns}).")
-
-            create_user_queries_sql = '''
-                CREATE TABLE IF NOT EXISTS user_queries (
-                    session_id VARCHAR(255) NOT NULL,
-                    query_ts INTEGER NOT NULL,
-                    location_string VARCHAR(255) NOT NULL,
-                    start_date INTEGER,
-                    end_date INTEGER,
-                    PRIMARY KEY (session_id, query_ts)
-                )
-            '''
-            cursor.execute(create_user_queries_sql)
-            conn.commit()
+def _fetch_current_row(cursor, lat, lon, max_age_seconds=CACHE_DURATION_SECONDS):
+    """Returns the newest weather_cache row (data, data_gz, fetch_ts) younger than max_age_seconds for already-snapped coordinates."""
+    min_fetch_ts = int(time.time()) - max_age_seconds
+    if WEATHER_CACHE_SPATIAL_MODE == 'geohash':
+        cursor.execute("""
+            SELECT data, data_gz, fetch_ts FROM weather_cache
+            WHERE geohash = %s AND kind = 'current' AND fetch_ts > %s
+            ORDER BY fetch_ts DESC
+            LIMIT 1
+        """, (geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION), min_fetch_ts))
+    else:
+        cursor.execute("""
+            SELECT data, data_gz, fetch_ts FROM weather_cache
+            WHERE lat = %s AND lon = %s AND kind = 'current' AND fetch_ts > %s
+            ORDER BY fetch_ts DESC
+            LIMIT 1
+        """, (lat, lon, min_fetch_ts))
+    row = cursor.fetchone()
+    if not row and WEATHER_CACHE_SPATIAL_MODE != 'exact':
+        row = _nearest_fresh_row(cursor, lat, lon, min_fetch_ts)
+    return row
+
+def _l1_expiry(row):
+    return min(row['fetch_ts'] + CACHE_DURATION_SECONDS, time.time() + L1_CACHE_TTL_SECONDS)
 
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
 def get_cache(lat=None, lon=None, target_data_ts=None, location=None):
     """
     Retrieves weather data from cache.
     target_data_ts: If None, fetches the latest fresh current weather. If provided, fetches specific historical data.
     location: Used as a fallback to find lat/lon if lat/lon are not provided, primarily for current weather or to aid historical lookup.
     """
+    lat, lon = snap_coordinates(lat, lon)
+    if target_data_ts is None and lat is not None and lon is not None:
+        l1_data = _weather_l1.get(("current", lat, lon))
+        if l1_data is not None:
+            return dict(l1_data) # Shallow copy so callers can add name/coord without touching the cached dict
+
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             # If lat and lon are not provided, try to find a recent entry by location string to get lat/lon first
@@ -163,116 +448,686 @@ def get_cache(lat=None, lon=None, target_data_ts=None, location=None):
                 return None
 
             if target_data_ts is None: # Fetch latest current weather by lat/lon
-                cursor.execute("""
-                    SELECT data FROM weather_cache
-                    WHERE lat = %s AND lon = %s AND fetch_ts > %s
-                    ORDER BY fetch_ts DESC
-                    LIMIT 1
-                """, (lat, lon, int(time.time()) - CACHE_DURATION_SECONDS))
+                row = _fetch_current_row(cursor, lat, lon)
+                if not row:
+                    return None
+                text = _payload_json(row)
+                data = json.loads(text)
+                size = len(text) # L1 holds the decoded dict, so charge at least the uncompressed size
+                _weather_l1.set(("current", lat, lon), data, expires_at=_l1_expiry(row), size=size)
+                return dict(data)
             else: # Fetch specific historical data by lat/lon and data_ts
                 cursor.execute("""
-                    SELECT data FROM weather_cache
+                    SELECT data, data_gz FROM weather_cache
                     WHERE lat = %s AND lon = %s AND data_ts = %s
                     LIMIT 1
                 """, (lat, lon, target_data_ts))
             
             row = cursor.fetchone()
-    return json.loads(row['data']) if row else None
+    return _decode_payload(row) if row else None
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_stale_cache(lat, lon, stale_seconds=None):
+    """
+    Returns (data, fetch_ts) for the newest current-weather entry that has expired but is within stale_seconds
+    (default CACHE_STALE_SECONDS) of expiry, or None. Meant for stale-while-revalidate after get_cache misses,
+    or with a longer window when upstream is unavailable; not cached in L1.
+    """
+    if stale_seconds is None:
+        stale_seconds = CACHE_STALE_SECONDS
+    if stale_seconds <= 0:
+        return None
+    lat, lon = snap_coordinates(lat, lon)
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            row = _fetch_current_row(cursor, lat, lon, CACHE_DURATION_SECONDS + stale_seconds)
+    return (_decode_payload(row), row['fetch_ts']) if row else None
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_cache_many(coordinates):
+    """
+    Batch form of get_cache for current weather.
+    Takes (lat, lon) pairs and returns {snap_coordinates(lat, lon): data} for every location with a fresh entry,
+    using the L1 tier first and a single IN (...) query for the rest.
+    """
+    found, missing = {}, []
+    for lat, lon in coordinates:
+        key = snap_coordinates(lat, lon)
+        if key in found or key in missing:
+            continue
+        l1_data = _weather_l1.get(("current",) + key)
+        if l1_data is not None:
+            found[key] = dict(l1_data)
+        else:
+            missing.append(key)
+    if not missing:
+        return found
+
+    min_fetch_ts = int(time.time()) - CACHE_DURATION_SECONDS
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            if WEATHER_CACHE_SPATIAL_MODE == 'geohash':
+                cells = {geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION): (lat, lon) for lat, lon in missing}
+                cursor.execute(f"""
+                    SELECT geohash, data, data_gz, fetch_ts FROM weather_cache
+                    WHERE geohash IN ({", ".join(["%s"] * len(cells))}) AND kind = 'current' AND fetch_ts > %s
+                """, (*cells, min_fetch_ts))
+                rows = [(cells[row['geohash']], row) for row in cursor.fetchall()]
+            else:
+                cursor.execute(f"""
+                    SELECT lat, lon, data, data_gz, fetch_ts FROM weather_cache
+                    WHERE {backend.row_in(("lat", "lon"), len(missing))} AND kind = 'current' AND fetch_ts > %s
+                """, (*[value for key in missing for value in key], min_fetch_ts))
+                rows = [((row['lat'], row['lon']), row) for row in cursor.fetchall()]
+
+            newest = {}
+            for key, row in rows:
+                if key not in newest or row['fetch_ts'] > newest[key]['fetch_ts']:
+                    newest[key] = row
+            if WEATHER_CACHE_SPATIAL_MODE != 'exact':
+                for key in missing:
+                    if key not in newest:
+                        row = _nearest_fresh_row(cursor, key[0], key[1], min_fetch_ts)
+                        if row:
+                            newest[key] = row
+
+    for key, row in newest.items():
+        text = _payload_json(row)
+        data = json.loads(text)
+        size = len(text) # See get_cache
+        _weather_l1.set(("current",) + key, data, expires_at=_l1_expiry(row), size=size)
+        found[key] = dict(data)
+    return found
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_cache_payload(lat, lon):
+    """
+    Returns the latest fresh current-weather payload as stored, without JSON decoding:
+    (body_bytes, 'gzip') for compressed rows, (body_bytes, 'identity') for JSON text rows, or None on a miss.
+    The payload already carries the name/coord written by set_cache.
+    """
+    lat, lon = snap_coordinates(lat, lon)
+    payload = _weather_l1.get(("payload", lat, lon))
+    if payload is not None:
+        return payload
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            row = _fetch_current_row(cursor, lat, lon)
+    if not row:
+        return None
+    if row.get('data_gz') is not None:
+        payload = (row['data_gz'], 'gzip')
+    else:
+        payload = (row['data'].encode(), 'identity')
+    _weather_l1.set(("payload", lat, lon), payload, expires_at=_l1_expiry(row), size=len(payload[0]))
+    return payload
+
+def geocode_cache_key(kind, *parts):
+    """Builds a normalized geocode cache key, e.g. ('city', ' New  York') -> 'city:new york'."""
+    normalized = [" ".join(str(part).split()).lower() for part in parts]
+    key = f"{kind}:" + "|".join(normalized)
+    return key if len(key) <= 255 else f"{kind}:sha1:" + hashlib.sha1(key.encode()).hexdigest()
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_geocode(query_key):
+    """
+    Looks up a cached geocoding result.
+    Returns {'found', 'lat', 'lon', 'name'} (found=False for a cached "not found"), or None on a miss.
+    """
+    entry = _geocode_l1.get(query_key)
+    if entry is not None:
+        return entry
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT found, lat, lon, name, fetch_ts FROM geocode_cache
+                WHERE query_key = %s
+            """, (query_key,))
+            row = cursor.fetchone()
+    if not row:
+        return None
+    duration = GEOCODE_CACHE_DURATION_SECONDS if row['found'] else GEOCODE_NEGATIVE_CACHE_DURATION_SECONDS
+    expires_at = row['fetch_ts'] + duration
+    if expires_at <= time.time():
+        return None
+    entry = {'found': bool(row['found']), 'lat': row['lat'], 'lon': row['lon'], 'name': row['name']}
+    _geocode_l1.set(query_key, entry, expires_at=expires_at)
+    return entry
 
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def set_geocode(query_key, lat, lon, name, found=True):
+    """Stores a geocoding result (or a negative result with found=False) and returns it as get_geocode would."""
+    fetch_ts = int(time.time())
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                REPLACE INTO geocode_cache (query_key, found, lat, lon, name, fetch_ts)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (query_key, int(found), lat, lon, name, fetch_ts))
+        conn.commit()
+    entry = {'found': found, 'lat': lat, 'lon': lon, 'name': name}
+    duration = GEOCODE_CACHE_DURATION_SECONDS if found else GEOCODE_NEGATIVE_CACHE_DURATION_SECONDS
+    _geocode_l1.set(query_key, entry, expires_at=fetch_ts + duration)
+    return entry
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
 def get_cache_for_range(lat, lon, start_date_ts, end_date_ts):
     """
     Retrieves historical weather data from cache for a given lat/lon and date range.
     Returns a dictionary mapping data_ts to fetched data.
     """
+    lat, lon = snap_coordinates(lat, lon)
     cached_data = {}
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             # Fetch all records within the timestamp range for the given lat/lon
             cursor.execute("""
-                SELECT data_ts, data FROM weather_cache
-                WHERE lat = %s AND lon = %s AND data_ts BETWEEN %s AND %s
+                SELECT data_ts, data, data_gz FROM weather_cache
+                WHERE lat = %s AND lon = %s AND kind = 'history' AND data_ts BETWEEN %s AND %s
             """, (lat, lon, start_date_ts, end_date_ts))
             rows = cursor.fetchall()
             for row in rows:
-                cached_data[row['data_ts']] = json.loads(row['data'])
+                cached_data[row['data_ts']] = _decode_payload(row)
     return cached_data
 
-def set_cache(lat, lon, location, data, data_ts):
-    """Stores weather data in cache."""
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def set_cache(lat, lon, location, data, data_ts, kind='current'):
+    """
+    Stores weather data in cache.
+    kind: 'current' for current-weather snapshots, 'history' for historical (time machine) data, which
+    current-weather lookups ignore.
+    """
+    lat, lon = snap_coordinates(lat, lon)
+    geohash = geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION)
+    data_text, data_gz = _encode_payload(data)
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-                REPLACE INTO weather_cache (lat, lon, loc, data_ts, fetch_ts, data)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (lat, lon, location, data_ts, int(time.time()), json.dumps(data)))
+                REPLACE INTO weather_cache (lat, lon, loc, data_ts, fetch_ts, data, data_gz, geohash, kind)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (lat, lon, location, data_ts, int(time.time()), data_text, data_gz, geohash, kind))
         conn.commit()
+    _invalidate_weather_l1({'lat': lat, 'lon': lon})
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def set_cache_many(entries, kind='current'):
+    """Stores many (lat, lon, location, data, data_ts) entries of one kind (see set_cache) with a single multi-row REPLACE."""
+    if not entries:
+        return
+    fetch_ts = int(time.time())
+    rows = []
+    for lat, lon, location, data, data_ts in entries:
+        lat, lon = snap_coordinates(lat, lon)
+        data_text, data_gz = _encode_payload(data)
+        rows.append((lat, lon, location, data_ts, fetch_ts, data_text, data_gz, geohash_encode(lat, lon, WEATHER_CACHE_GEOHASH_PRECISION), kind))
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                REPLACE INTO weather_cache (lat, lon, loc, data_ts, fetch_ts, data, data_gz, geohash, kind)
+                VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows))}
+            """, [value for row in rows for value in row])
+        conn.commit()
+    if kind == 'current':
+        for row in rows:
+            _invalidate_weather_l1({'lat': row[0], 'lon': row[1]})
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def _insert_user_queries(rows):
+    """Writes (session_id, query_ts, location_string, start_date, end_date) rows with one multi-row INSERT."""
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    params = [value for row in rows for value in row]
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO user_queries (session_id, query_ts, location_string, start_date, end_date)
+                VALUES {placeholders}
+            """, params)
+            conn.commit()
+
+class QueryLogWriter:
+    """
+    Write-behind buffer for user_queries. Entries are queued in memory and written by a background thread
+    as multi-row INSERTs once QUERY_LOG_FLUSH_SIZE entries are waiting or every QUERY_LOG_FLUSH_INTERVAL_SECONDS.
+    When the buffer is full, overflow_policy 'drop' discards the new entry and 'block' makes the caller wait
+    (up to block_timeout seconds) for the writer to catch up.
+    """
+    def __init__(self, flush_size, flush_interval, max_buffer, overflow_policy, block_timeout):
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self.max_buffer = max(self.flush_size, max_buffer)
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stops the background thread and flushes whatever is still buffered."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
 
-def log_user_query(session_id, location_string, query_ts=None):
-    """Logs a user query to the database."""
+    def enqueue(self, row):
+        """Queues a row; returns False if it was dropped because the buffer is full."""
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer:
+                if self.overflow_policy == 'block':
+                    self._cond.wait_for(lambda: len(self._buffer) < self.max_buffer, self.block_timeout)
+                if len(self._buffer) >= self.max_buffer:
+                    self.dropped += 1
+                    return False
+            self._buffer.append(row)
+            self.enqueued += 1
+            if len(self._buffer) >= self.flush_size:
+                self._cond.notify_all()
+            return True
+
+    def flush(self):
+        """Writes everything currently buffered from the calling thread."""
+        while self._write_batch():
+            pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                "buffered": len(self._buffer),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "flushes": self.flushes,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping or len(self._buffer) >= self.flush_size, self.flush_interval)
+                if self._stopping:
+                    return # stop() flushes the remainder
+            while self._write_batch():
+                pass
+
+    def _write_batch(self):
+        with self._cond:
+            if not self._buffer:
+                return False
+            batch = [self._buffer.popleft() for _ in range(min(self.flush_size, len(self._buffer)))]
+            self._cond.notify_all() # Wake producers blocked on a full buffer
+        try:
+            _insert_user_queries(batch)
+        except backend.Error as err:
+            print(f"Database error writing {len(batch)} user queries: {err}")
+            with self._cond:
+                self.failed += len(batch)
+            return False # Leave the rest for the next interval rather than hammering a failing database
+        with self._cond:
+            self.written += len(batch)
+            self.flushes += 1
+        return True
+
+_query_log_writer = QueryLogWriter(
+    flush_size=QUERY_LOG_FLUSH_SIZE,
+    flush_interval=QUERY_LOG_FLUSH_INTERVAL_SECONDS,
+    max_buffer=QUERY_LOG_MAX_BUFFER,
+    overflow_policy=QUERY_LOG_OVERFLOW_POLICY,
+    block_timeout=QUERY_LOG_BLOCK_TIMEOUT_SECONDS,
+)
+
+def start_query_log_writer():
+    """Starts write-behind logging for log_user_query (call on application startup)."""
+    _query_log_writer.start()
+
+def stop_query_log_writer():
+    """Stops the background writer and flushes buffered queries (call on application shutdown)."""
+    _query_log_writer.stop()
+
+def get_query_log_stats():
+    return _query_log_writer.stats()
+
+def log_user_query(session_id, location_string, query_ts=None, start_date=None, end_date=None):
+    """
+    Logs a user query to the database. start_date/end_date (epoch seconds) are set for range (history) queries.
+    While the write-behind writer is running the entry is only buffered, so the caller never waits on
+    (or fails because of) the INSERT; otherwise it is written immediately.
+    """
     if query_ts is None:
         query_ts = int(time.time())
+    row = (session_id, query_ts, location_string, start_date, end_date)
+    if _query_log_writer.running:
+        _query_log_writer.enqueue(row)
+        return
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                # Ensure the 'start_date' and 'end_date' columns are handled correctly
-                # in your CREATE TABLE statement or by passing None if not used.
-                # Assuming here the user_queries table only has (session_id, query_ts, location_string) for simplicity.
-                cursor.execute("""
-                    INSERT INTO user_queries (session_id, query_ts, location_string)
-                    VALUES (%s, %s, %s)
-                    ON DUPLICATE KEY UPDATE location_string = VALUES(location_string)
-                """, (session_id, query_ts, location_string))
-                conn.commit()
+        _insert_user_queries([row])
         print(f"Logged query: '{location_string}' for session '{session_id}'")
-    except pymysql.Error as err:
+    except backend.Error as err:
         print(f"Database error logging user query: {err}")
         raise # Re-raise to let FastAPI handle it as a 500 error
 
+UPSTREAM_QUOTA_KEEP_SECONDS = 2 * 86400 # Quota windows older than this are deleted when a new window starts
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def lease_upstream_quota(api, period, window_start, amount, limit):
+    """
+    Reserves up to `amount` upstream calls for this worker in the shared (api, period, window_start) quota window.
+    Returns the number granted: `amount`, 1 when fewer than `amount` but at least one remain, or 0 when the window is used up.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"{backend.insert_ignore()} upstream_quota (api, period, window_start, used) VALUES (%s, %s, %s, 0)",
+                (api, period, window_start),
+            )
+            if cursor.rowcount:
+                cursor.execute(
+                    "DELETE FROM upstream_quota WHERE api = %s AND period = %s AND window_start < %s",
+                    (api, period, window_start - UPSTREAM_QUOTA_KEEP_SECONDS),
+                )
+            granted = 0
+            for size in (amount, 1) if amount > 1 else (amount,):
+                cursor.execute(
+                    "UPDATE upstream_quota SET used = used + %s WHERE api = %s AND period = %s AND window_start = %s AND used + %s <= %s",
+                    (size, api, period, window_start, size, limit),
+                )
+                if cursor.rowcount:
+                    granted = size
+                    break
+        conn.commit()
+    return granted
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_prewarm_candidates(since_ts, top_n, expires_before_ts):
+    """
+    Finds the top_n most-queried location_strings since since_ts whose latest weather_cache entry expires
+    before expires_before_ts (or has already expired). Returns dicts with location_string, hits, lat, lon, fetch_ts,
+    most popular first. Locations never cached have no coordinates to refresh and are skipped.
+    """
+    candidates = []
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT location_string, COUNT(*) AS hits FROM user_queries
+                WHERE query_ts > %s
+                GROUP BY location_string
+                ORDER BY hits DESC
+                LIMIT %s
+            """, (since_ts, top_n))
+            for popular in cursor.fetchall():
+                cursor.execute("""
+                    SELECT lat, lon, fetch_ts FROM weather_cache
+                    WHERE loc = %s AND kind = 'current'
+                    ORDER BY fetch_ts DESC
+                    LIMIT 1
+                """, (popular['location_string'],))
+                latest = cursor.fetchone()
+                if latest and latest['fetch_ts'] + CACHE_DURATION_SECONDS < expires_before_ts:
+                    candidates.append({**popular, **latest})
+    return candidates
+
+def _delete_weather_rows(cursor, keys):
+    cursor.execute(
+        f"DELETE FROM weather_cache WHERE {backend.row_in(('lat', 'lon', 'data_ts'), len(keys))}",
+        [value for key in keys for value in key],
+    )
+    return cursor.rowcount
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def purge_weather_cache(retention_seconds=None, keep_latest=None, batch_size=None, pause_seconds=None):
+    """
+    Applies the weather_cache retention rules in small batches, committing after each so no statement holds
+    locks for long. Returns {'expired': rows past retention, 'excess': rows beyond keep_latest, 'seconds': duration}.
+    """
+    retention_seconds = WEATHER_CACHE_RETENTION_SECONDS if retention_seconds is None else retention_seconds
+    keep_latest = WEATHER_CACHE_KEEP_LATEST if keep_latest is None else keep_latest
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    pause_seconds = RETENTION_BATCH_PAUSE_SECONDS if pause_seconds is None else pause_seconds
+    started = time.monotonic()
+    expired = excess = 0
+
+    if retention_seconds > 0:
+        cutoff = int(time.time()) - retention_seconds
+        while True:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT lat, lon, data_ts FROM weather_cache
+                        WHERE fetch_ts < %s
+                        LIMIT %s
+                    """, (cutoff, batch_size))
+                    keys = [(row['lat'], row['lon'], row['data_ts']) for row in cursor.fetchall()]
+                    if keys:
+                        expired += _delete_weather_rows(cursor, keys)
+                        conn.commit()
+            if len(keys) < batch_size:
+                break
+            time.sleep(pause_seconds)
+
+    if keep_latest > 0:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT lat, lon, kind FROM weather_cache
+                    GROUP BY lat, lon, kind
+                    HAVING COUNT(*) > %s
+                """, (keep_latest,))
+                cells = [(row['lat'], row['lon'], row['kind']) for row in cursor.fetchall()]
+        for lat, lon, kind in cells:
+            while True:
+                with get_db_connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute("""
+                            SELECT data_ts FROM weather_cache
+                            WHERE lat = %s AND lon = %s AND kind = %s
+                            ORDER BY data_ts DESC
+                            LIMIT %s, %s
+                        """, (lat, lon, kind, keep_latest, batch_size))
+                        keys = [(lat, lon, row['data_ts']) for row in cursor.fetchall()]
+                        if keys:
+                            excess += _delete_weather_rows(cursor, keys)
+                            conn.commit()
+                if len(keys) < batch_size:
+                    break
+                time.sleep(pause_seconds)
+
+    return {'expired': expired, 'excess': excess, 'seconds': round(time.monotonic() - started, 3)}
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_table_stats():
+    """Returns approximate row counts and on-disk sizes (bytes) for every table in the database."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            return backend.table_stats(cursor)
+
 def get_all_user_queries():
     """Retrieves all user queries."""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT session_id, query_ts, location_string, start_date, end_date FROM user_queries ORDER BY query_ts DESC")
+            cursor.execute("SELECT id, session_id, query_ts, location_string, start_date, end_date FROM user_queries ORDER BY query_ts DESC, id DESC")
             return cursor.fetchall()
 
 def get_table_names():
     """Retrieves all table names in the database."""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SHOW TABLES;")
-            # When using DictCursor, 'SHOW TABLES' returns a dictionary
-            # with a key like 'Tables_in_<DB_NAME>'.
-            return [row['Tables_in_' + DB_NAME] for row in cursor.fetchall()]
+            return backend.list_tables(cursor)
+
+def _describe_columns(cursor, table_name):
+    return backend.describe_columns(cursor, table_name)
 
 def get_table_columns(table_name):
     """Retrieves column names for a given table."""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(f"DESCRIBE `{table_name}`;")
-            return [row['Field'] for row in cursor.fetchall()]
+            return _describe_columns(cursor, table_name)
+
+def _primary_key_columns(cursor, table_name):
+    return backend.primary_key_columns(cursor, table_name)
 
 def get_table_primary_key_columns(table_name):
     """Retrieves primary key column names for a given table."""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(f"""
-                SELECT COLUMN_NAME
-                FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
-                WHERE TABLE_SCHEMA = '{DB_NAME}' AND TABLE_NAME = '{table_name}' AND CONSTRAINT_NAME = 'PRIMARY'
-                ORDER BY ORDINAL_POSITION;
-            """)
-            return [row['COLUMN_NAME'] for row in cursor.fetchall()]
-
-def get_table_data(table_name, order_by_column=None, order_direction='ASC'):
-    """Retrieves all data from a specified table with optional sorting."""
+            return _primary_key_columns(cursor, table_name)
+
+def _encode_page_cursor(values):
+    """Cursor token for raw sort-key values; binary values (e.g. ordering by data_gz) are carried as {"b64": ...}."""
+    values = [{"b64": base64.b64encode(v).decode()} if isinstance(v, (bytes, bytearray)) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_page_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return [base64.b64decode(v["b64"]) if isinstance(v, dict) else v for v in values]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid page cursor: {e}")
+
+def _build_table_query(cursor, table_name, order_by_column, order_direction, columns, limit=None, after=None):
+    """
+    Builds a validated SELECT for the admin table browser.
+    Rows are ordered by order_by_column (if any) and then the primary key, so (order column, pk...) is a unique
+    sort key usable for keyset pagination. Returns (sql, params, sort_columns).
+    """
+    table_columns = _describe_columns(cursor, table_name)
+    direction = 'DESC' if str(order_direction).upper() == 'DESC' else 'ASC'
+    pk_columns = _primary_key_columns(cursor, table_name)
+    if order_by_column and order_by_column not in table_columns:
+        order_by_column = None
+
+    if order_by_column in pk_columns:
+        sort_columns = [order_by_column] + [c for c in pk_columns if c != order_by_column]
+        order_by_column = None # Already unique as part of the key
+    elif order_by_column:
+        sort_columns = [order_by_column] + pk_columns
+    else:
+        sort_columns = list(pk_columns)
+
+    if columns:
+        unknown = [c for c in columns if c not in table_columns]
+        if unknown:
+            raise ValueError(f"Unknown column(s) for table '{table_name}': {', '.join(unknown)}")
+        # Sort key columns are always returned so rows stay identifiable and pageable
+        selected = list(columns) + [c for c in sort_columns if c not in columns]
+        select_list = ", ".join(f"`{c}`" for c in selected)
+    else:
+        select_list = "*"
+
+    sql = f"SELECT {select_list} FROM `{table_name}`"
+    params = []
+    if after is not None:
+        if not pk_columns:
+            raise ValueError(f"Table '{table_name}' has no primary key to paginate on.")
+        if len(after) != len(sort_columns):
+            raise ValueError("Page cursor does not match the requested ordering.")
+        condition, params = _keyset_condition(order_by_column, sort_columns, after, direction)
+        sql += f" WHERE {condition}"
+    if sort_columns:
+        sql += " ORDER BY " + ", ".join(f"`{c}` {direction}" for c in sort_columns)
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params, sort_columns
+
+def _keyset_condition(order_by_column, sort_columns, last_values, direction):
+    """WHERE clause selecting rows strictly after last_values in (sort_columns) order."""
+    op = '>' if direction == 'ASC' else '<'
+    key_columns = sort_columns[1:] if order_by_column else sort_columns
+    key_values = list(last_values[1:] if order_by_column else last_values)
+    key_condition = f"({', '.join(f'`{c}`' for c in key_columns)}) {op} ({', '.join(['%s'] * len(key_columns))})"
+    if not order_by_column:
+        return key_condition, key_values
+
+    # The non-key order column may be NULL; MySQL and SQLite sort NULLs first ascending and last descending.
+    column, last_value = f"`{order_by_column}`", last_values[0]
+    if last_value is None:
+        if direction == 'ASC':
+            return f"(({column} IS NULL AND {key_condition}) OR {column} IS NOT NULL)", key_values
+        return f"({column} IS NULL AND {key_condition})", key_values
+    condition = f"{column} {op} %s OR ({column} = %s AND {key_condition})"
+    if direction == 'DESC':
+        condition += f" OR {column} IS NULL"
+    return f"({condition})", [last_value, last_value] + key_values
+
+def _present_row(row):
+    """Makes a row JSON-friendly for the admin browser: gzip blobs are shown decompressed in place of a NULL `data`."""
+    for column, value in row.items():
+        if isinstance(value, (bytes, bytearray)):
+            if value[:2] == b'\x1f\x8b':
+                if 'data' in row and row['data'] is None:
+                    row['data'] = gzip.decompress(value).decode()
+                row[column] = f"<gzip, {len(value)} bytes>"
+            else:
+                row[column] = base64.b64encode(value).decode()
+    return row
+
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
+def get_table_data(table_name, order_by_column=None, order_direction='ASC', columns=None, limit=None, cursor_token=None):
+    """
+    Retrieves data from a specified table with optional sorting and column projection.
+    Without a limit, returns every row as a list. With a limit, returns one keyset page as
+    {'rows': [...], 'next_cursor': token or None}; pass next_cursor back as cursor_token for the following page.
+    """
+    after = _decode_page_cursor(cursor_token) if cursor_token else None
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            query = f"SELECT * FROM `{table_name}`"
-            if order_by_column and order_by_column in get_table_columns(table_name):
-                query += f" ORDER BY `{order_by_column}` {order_direction}"
-            cursor.execute(query)
-            return cursor.fetchall()
+            query, params, sort_columns = _build_table_query(cursor, table_name, order_by_column, order_direction, columns, limit, after)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+    next_cursor = None
+    if limit is not None and len(rows) == limit and sort_columns:
+        # From the raw values: _present_row rewrites some (a NULL `data` becomes the decompressed payload)
+        next_cursor = _encode_page_cursor([rows[-1][c] for c in sort_columns])
+    rows = [_present_row(row) for row in rows]
+    if limit is None:
+        return rows
+    return {"rows": rows, "next_cursor": next_cursor}
+
+def iter_table_data(table_name, order_by_column=None, order_direction='ASC', columns=None):
+    """
+    Streams every row of a table through an unbuffered (server-side on MySQL) cursor.
+    The query is validated eagerly (errors raise here); the returned generator yields rows as they arrive.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            query, params, _ = _build_table_query(cursor, table_name, order_by_column, order_direction, columns)
+
+    def rows():
+        conn = get_db_connection()
+        cursor = backend.streaming_cursor(conn)
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield _present_row(row)
+        except BaseException:
+            # Abandoned or failed mid-stream: closing the connection is cheaper than draining the unread result set
+            conn.discard()
+            raise
+        else:
+            cursor.close()
+            conn.close()
+    return rows()
 
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
 def update_record(table_name, pk_dict, field_to_update, new_value):
     """Updates a specific field in a record identified by its primary key."""
     with get_db_connection() as conn:
@@ -289,10 +1144,18 @@ def update_record(table_name, pk_dict, field_to_update, new_value):
                 final_value_for_db = json.dumps(new_value) 
             
             sql = f"UPDATE `{table_name}` SET `{field_to_update}` = %s WHERE {where_clause}"
+            if table_name == 'weather_cache' and field_to_update == 'data':
+                # An edited payload replaces any compressed copy, which would otherwise take precedence on read
+                sql = f"UPDATE `{table_name}` SET `data` = %s, `data_gz` = NULL WHERE {where_clause}"
             params = [final_value_for_db] + pk_values
             cursor.execute(sql, params)
             conn.commit()
+    if table_name == 'weather_cache':
+        _invalidate_weather_l1_for_edit(pk_dict)
+    elif table_name == 'geocode_cache':
+        _geocode_l1.clear()
 
+@metrics.timed(metrics.DB_CALL_SECONDS, request_bucket='db')
 def delete_record(table_name, pk_dict):
     """Deletes a record from a specified table identified by its primary key."""
     with get_db_connection() as conn:
@@ -302,4 +1165,8 @@ def delete_record(table_name, pk_dict):
             sql = f"DELETE FROM `{table_name}` WHERE {where_clause}"
             params = list(pk_dict.values())
             cursor.execute(sql, params)
-            conn.commit()
\ No newline at end of file
+            conn.commit()
+    if table_name == 'weather_cache':
+        _invalidate_weather_l1_for_edit(pk_dict)
+    elif table_name == 'geocode_cache':
+        _geocode_l1.clear()
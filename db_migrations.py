@@ -0,0 +1,248 @@
+# db_migrations.py
+"""
+Versioned schema migrations for the weather database.
+
+Each migration is idempotent and runs at most once; applied versions are recorded in `schema_version`.
+Apply pending migrations with:
+
+    python db_migrations.py            # migrate to the latest version
+    python db_migrations.py status     # show current and latest version
+"""
+import sys
+import time
+
+import db_cache
+from utils.geo import geohash_encode
+
+MIGRATION_LOCK_NAME = "schema_migrations"
+MIGRATION_LOCK_TIMEOUT_SECONDS = 600
+
+def _column_exists(cursor, table_name, column_name):
+    return db_cache.backend.column_exists(cursor, table_name, column_name)
+
+def _index_exists(cursor, table_name, index_name):
+    return db_cache.backend.index_exists(cursor, table_name, index_name)
+
+def _m001_baseline(cursor):
+    """weather_cache and user_queries, including upgrades of pre-versioning weather_cache tables."""
+    table_name = "weather_cache"
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            data_ts INTEGER NOT NULL,
+            fetch_ts INTEGER NOT NULL,
+            loc VARCHAR(255),
+            data TEXT,
+            PRIMARY KEY (lat, lon, data_ts)
+        )
+    ''')
+    if db_cache.backend.name == 'mysql': # Pre-versioning databases only ever existed on MySQL
+        _upgrade_unversioned_weather_cache(cursor, table_name)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_queries (
+            session_id VARCHAR(255) NOT NULL,
+            query_ts INTEGER NOT NULL,
+            location_string VARCHAR(255) NOT NULL,
+            start_date INTEGER,
+            end_date INTEGER,
+            PRIMARY KEY (session_id, query_ts)
+        )
+    ''')
+
+def _upgrade_unversioned_weather_cache(cursor, table_name):
+    """Brings a weather_cache table created before data_ts/fetch_ts and the composite key existed up to the baseline."""
+    for column in ('data_ts', 'fetch_ts'):
+        if not _column_exists(cursor, table_name, column):
+            print(f"Adding '{column}' column to {table_name}...")
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} INTEGER;")
+
+    cursor.execute(f"UPDATE {table_name} SET data_ts = 0 WHERE data_ts IS NULL;")
+    cursor.execute(f"UPDATE {table_name} SET fetch_ts = %s WHERE fetch_ts IS NULL;", (int(time.time()),))
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME IN ('data_ts', 'fetch_ts') AND IS_NULLABLE = 'YES'
+    """, (db_cache.DB_NAME, table_name))
+    for row in cursor.fetchall():
+        print(f"Setting {row['COLUMN_NAME']} to NOT NULL in {table_name}...")
+        cursor.execute(f"ALTER TABLE {table_name} MODIFY COLUMN {row['COLUMN_NAME']} INTEGER NOT NULL;")
+
+    current_pk_columns = db_cache._primary_key_columns(cursor, table_name)
+    required_pk_columns = ['lat', 'lon', 'data_ts']
+    if sorted(current_pk_columns) != sorted(required_pk_columns):
+        print(f"Primary key needs update for {table_name}. Current: {current_pk_columns}, Required: {required_pk_columns}")
+        if current_pk_columns:
+            cursor.execute(f"ALTER TABLE {table_name} DROP PRIMARY KEY;")
+        try:
+            cursor.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (lat, lon, data_ts);")
+        except db_cache.backend.Error:
+            print("This usually means duplicate (lat, lon, data_ts) entries exist in your data, or NULL values are still present.")
+            raise
+
+def _m002_geocode_cache(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query_key VARCHAR(255) NOT NULL,
+            found INTEGER NOT NULL,
+            lat REAL,
+            lon REAL,
+            name VARCHAR(255),
+            fetch_ts INTEGER NOT NULL,
+            PRIMARY KEY (query_key)
+        )
+    ''')
+
+def _m003_weather_cache_geohash(cursor):
+    if not _column_exists(cursor, 'weather_cache', 'geohash'):
+        print("Adding 'geohash' column to weather_cache...")
+        cursor.execute("ALTER TABLE weather_cache ADD COLUMN geohash VARCHAR(12);")
+    cursor.execute("SELECT DISTINCT lat, lon FROM weather_cache WHERE geohash IS NULL")
+    cells = [(geohash_encode(row['lat'], row['lon'], db_cache.WEATHER_CACHE_GEOHASH_PRECISION), row['lat'], row['lon']) for row in cursor.fetchall()]
+    if cells:
+        print(f"Backfilling geohash for {len(cells)} locations in weather_cache...")
+        cursor.executemany("UPDATE weather_cache SET geohash = %s WHERE lat = %s AND lon = %s", cells)
+    if not _index_exists(cursor, 'weather_cache', 'idx_weather_cache_geohash'):
+        print("Adding geohash index to weather_cache...")
+        cursor.execute("CREATE INDEX idx_weather_cache_geohash ON weather_cache (geohash, fetch_ts);")
+
+def _m004_weather_cache_data_gz(cursor):
+    if not _column_exists(cursor, 'weather_cache', 'data_gz'):
+        print("Adding 'data_gz' column to weather_cache...")
+        cursor.execute("ALTER TABLE weather_cache ADD COLUMN data_gz LONGBLOB;")
+
+def _m005_cache_access_indexes(cursor):
+    """Indexes for the location fallback, the lat/lon freshness lookup, age-based purges and popularity scans."""
+    indexes = [
+        ('weather_cache', 'idx_weather_cache_loc_fetch', '(loc, fetch_ts)'), # Covers SELECT lat, lon ... WHERE loc ORDER BY fetch_ts (pk is implicit)
+        ('weather_cache', 'idx_weather_cache_latlon_fetch', '(lat, lon, fetch_ts)'),
+        ('weather_cache', 'idx_weather_cache_fetch_ts', '(fetch_ts)'),
+        ('user_queries', 'idx_user_queries_query_ts', '(query_ts, location_string)'),
+    ]
+    for table_name, index_name, columns in indexes:
+        if not _index_exists(cursor, table_name, index_name):
+            print(f"Adding index {index_name} to {table_name}...")
+            cursor.execute(f"CREATE INDEX {index_name} ON {table_name} {columns};")
+
+def _m006_weather_cache_kind(cursor):
+    """Separates current-weather snapshots from historical rows so current lookups never return history."""
+    if not _column_exists(cursor, 'weather_cache', 'kind'):
+        print("Adding 'kind' column to weather_cache...")
+        cursor.execute("ALTER TABLE weather_cache ADD COLUMN kind VARCHAR(16) NOT NULL DEFAULT 'current';")
+
+def _m007_upstream_quota(cursor):
+    """Shared per-window upstream call counters, leased in blocks by each worker's upstream scheduler."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upstream_quota (
+            api VARCHAR(32) NOT NULL,
+            period VARCHAR(16) NOT NULL,
+            window_start INTEGER NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (api, period, window_start)
+        )
+    ''')
+
+def _m008_user_queries_id(cursor):
+    """
+    Gives every logged query its own key. The (session_id, query_ts) key collapsed all queries of a session within
+    the same second (and whole batches) into one row, which skewed the popularity counts used for pre-warming.
+    """
+    if _column_exists(cursor, 'user_queries', 'id'):
+        return
+    print("Adding 'id' primary key to user_queries...")
+    if db_cache.backend.name == 'mysql':
+        cursor.execute("ALTER TABLE user_queries DROP PRIMARY KEY, ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST;")
+        return
+    # SQLite can't change a primary key in place, so the table is rebuilt.
+    cursor.execute("DROP TABLE IF EXISTS user_queries_new")
+    cursor.execute('''
+        CREATE TABLE user_queries_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id VARCHAR(255) NOT NULL,
+            query_ts INTEGER NOT NULL,
+            location_string VARCHAR(255) NOT NULL,
+            start_date INTEGER,
+            end_date INTEGER
+        )
+    ''')
+    cursor.execute("""
+        INSERT INTO user_queries_new (session_id, query_ts, location_string, start_date, end_date)
+        SELECT session_id, query_ts, location_string, start_date, end_date FROM user_queries ORDER BY query_ts
+    """)
+    cursor.execute("DROP TABLE user_queries")
+    cursor.execute("ALTER TABLE user_queries_new RENAME TO user_queries")
+    cursor.execute("CREATE INDEX idx_user_queries_query_ts ON user_queries (query_ts, location_string);")
+
+# (version, description, migration). Append only; never renumber or edit an applied migration.
+MIGRATIONS = [
+    (1, "weather_cache and user_queries baseline", _m001_baseline),
+    (2, "geocode_cache table", _m002_geocode_cache),
+    (3, "weather_cache geohash column and index", _m003_weather_cache_geohash),
+    (4, "weather_cache compressed payload column", _m004_weather_cache_data_gz),
+    (5, "weather_cache and user_queries access-path indexes", _m005_cache_access_indexes),
+    (6, "weather_cache kind column", _m006_weather_cache_kind),
+    (7, "upstream_quota table", _m007_upstream_quota),
+    (8, "user_queries auto-increment id key", _m008_user_queries_id),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def ensure_database():
+    db_cache.backend.ensure_database()
+
+def _read_version(cursor):
+    try:
+        cursor.execute("SELECT MAX(version) AS version FROM schema_version")
+    except db_cache.backend.UndefinedTableError: # Table doesn't exist yet
+        return 0
+    return cursor.fetchone()['version'] or 0
+
+def get_schema_version():
+    """Returns the applied schema version (0 for an unversioned database). A single query."""
+    with db_cache.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            return _read_version(cursor)
+
+def migrate(target_version=LATEST_SCHEMA_VERSION):
+    """Applies pending migrations up to target_version. Serialized across workers/hosts by an advisory lock."""
+    ensure_database()
+    lock_conn = db_cache.acquire_advisory_lock(MIGRATION_LOCK_NAME, timeout=MIGRATION_LOCK_TIMEOUT_SECONDS)
+    if lock_conn is None:
+        raise RuntimeError("Timed out waiting for another process to finish migrating the schema.")
+    try:
+        with db_cache.get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER NOT NULL,
+                        description VARCHAR(255),
+                        applied_ts INTEGER NOT NULL,
+                        PRIMARY KEY (version)
+                    )
+                ''')
+                conn.commit()
+                current_version = _read_version(cursor)
+                for version, description, migration in MIGRATIONS:
+                    if version <= current_version or version > target_version:
+                        continue
+                    print(f"Applying migration {version}: {description}...")
+                    migration(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, description, applied_ts) VALUES (%s, %s, %s)",
+                        (version, description, int(time.time())),
+                    )
+                    conn.commit()
+                    current_version = version
+        print(f"Schema is at version {current_version}.")
+        return current_version
+    finally:
+        db_cache.release_advisory_lock(lock_conn, MIGRATION_LOCK_NAME)
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        migrate()
+    elif command == "status":
+        print(f"Schema version: {get_schema_version()} (latest: {LATEST_SCHEMA_VERSION})")
+    else:
+        print(f"Unknown command '{command}'. Usage: python db_migrations.py [migrate|status]")
+        sys.exit(2)
@@ -1,23 +1,63 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Query, Body
+from fastapi import FastAPI, HTTPException, Query, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, ConfigDict
 from typing import Any # Important: ensure this is imported
-import requests, os, json, time
+import asyncio, gzip, os, json, time
+from datetime import date, datetime, timedelta, timezone
 import uuid
 import db_cache
 from COUNTRIES import COUNTRIES
-from utils.google_places import get_google_places_suggestions_backend
+from utils import gazetteer, http_client, metrics, openweather, single_flight, upstream_scheduler
+from utils.google_places import get_autocomplete_cache_stats, get_google_places_suggestions_backend
 
 app = FastAPI()
 API_KEY = os.getenv("OPENWEATHER_API_KEY")
 GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
+METRICS_TIMING_HEADERS = os.getenv("METRICS_TIMING_HEADERS", "0") == "1" # Server-Timing on every response; otherwise only with `X-Debug-Timing: 1`
+GAZETTEER_DIR = os.getenv("GAZETTEER_DIR", "") # Offline gazetteer built by `python -m utils.gazetteer build`; empty disables it
+GAZETTEER = gazetteer.open_gazetteer(GAZETTEER_DIR, {code.upper(): name for name, code in COUNTRIES.items()}) if GAZETTEER_DIR else None
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(metrics.MetricsMiddleware, timing_headers=METRICS_TIMING_HEADERS)
+metrics.register_stats("db_pool_connections", "Database connection pool counters.", db_cache.get_pool_stats)
+metrics.register_stats("weather_l1_cache", "In-process weather cache counters.", db_cache.get_l1_cache_stats)
+metrics.register_stats("query_log_writer", "Buffered user_queries writer counters.", db_cache.get_query_log_stats)
+metrics.register_stats("autocomplete_cache", "Places autocomplete cache counters.", get_autocomplete_cache_stats)
+metrics.register_stats("upstream_scheduler", "Upstream token buckets and circuit breakers.", upstream_scheduler.get_stats)
+metrics.register_stats("single_flight", "Upstream fetches currently shared by concurrent requests.", lambda: {"inflight": single_flight.inflight_count()})
 @app.on_event("startup")
-async def startup_event(): db_cache.init_db()
+async def startup_event():
+    db_cache.init_db()
+    upstream_scheduler.set_quota_store(db_cache.lease_upstream_quota)
+    db_cache.start_query_log_writer()
+    if PREWARM_ENABLED:
+        _start_background_task(_prewarm_loop())
+    if RETENTION_INTERVAL_SECONDS > 0:
+        _start_background_task(_retention_loop())
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in list(_background_tasks):
+        task.cancel()
+    await http_client.close_client()
+    await asyncio.to_thread(db_cache.stop_query_log_writer)
+    db_cache.close_pool()
+
+STALE_IF_ERROR_SECONDS = int(os.getenv("STALE_IF_ERROR_SECONDS", "86400")) # How far past expiry to serve when upstream is unavailable
+
+@app.exception_handler(upstream_scheduler.UpstreamUnavailable)
+async def upstream_unavailable_handler(request: Request, exc: upstream_scheduler.UpstreamUnavailable):
+    headers = {"Retry-After": str(max(1, int(exc.retry_after + 0.999)))} if exc.retry_after else None
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers=headers)
 
 @app.get("/api/suggest-locations")
-async def suggest_locations(query: str): return get_google_places_suggestions_backend(query, GOOGLE_PLACES_API_KEY, types='locality')
+async def suggest_locations(query: str):
+    if GAZETTEER is not None:
+        suggestions = GAZETTEER.suggest(query)
+        metrics.GAZETTEER_LOOKUPS.inc(kind="suggest", result="hit" if suggestions else "miss")
+        if suggestions:
+            return suggestions
+    return await get_google_places_suggestions_backend(query, GOOGLE_PLACES_API_KEY, types='locality')
 
 class WeatherRequest(BaseModel):
     type: str
@@ -32,69 +72,430 @@ EDITABLE_TABLE_COLUMNS = {
     # Add other tables here if they need editable fields
 }
 
-@app.post("/api/weather/current")
-async def get_current_weather(req: WeatherRequest):
-    lat, lon, location_string = None, None, None
+async def resolve_location(req: WeatherRequest):
+    """Returns (lat, lon, location_string) for a request, using the offline gazetteer and geocode cache before calling upstream."""
     if req.type == 'city':
-        geo_res = requests.get(f"http://api.openweathermap.org/geo/1.0/direct?q={req.city}&limit=1&appid={API_KEY}").json()
-        if not geo_res:
+        if GAZETTEER is not None:
+            place = GAZETTEER.find_city(req.city)
+            metrics.GAZETTEER_LOOKUPS.inc(kind="city", result="hit" if place else "miss")
+            if place:
+                return place['lat'], place['lon'], ", ".join(part for part in (place['name'], place['state'], place['country']) if part)
+        geo_key = db_cache.geocode_cache_key('city', req.city)
+        geocoded = await asyncio.to_thread(db_cache.get_geocode, geo_key)
+        if geocoded is None:
+            geo_res = await openweather.geocode_city(req.city, API_KEY)
+            if not isinstance(geo_res, list): raise HTTPException(status_code=500, detail=f"Failed to geocode city: {geo_res.get('message')}")
+            if not geo_res:
+                geocoded = await asyncio.to_thread(db_cache.set_geocode, geo_key, None, None, None, found=False)
+            else:
+                name = f"{geo_res[0].get('name')}, {geo_res[0].get('state', '')}, {geo_res[0].get('country')}".strip(', ')
+                geocoded = await asyncio.to_thread(db_cache.set_geocode, geo_key, geo_res[0]['lat'], geo_res[0]['lon'], name)
+        if not geocoded['found']:
             raise HTTPException(status_code=400, detail=f"City not found: {req.city}")
-        lat, lon = geo_res[0]['lat'], geo_res[0]['lon']
-        location_string = f"{geo_res[0].get('name')}, {geo_res[0].get('state', '')}, {geo_res[0].get('country')}".strip(', ')
+        return geocoded['lat'], geocoded['lon'], geocoded['name']
     elif req.type == 'zip':
-        country_code = next((v for k,v in COUNTRIES.items() if k == req.country), None)
+        country_code = COUNTRIES.get(req.country)
         if not country_code: raise HTTPException(status_code=400, detail=f"Invalid country for zip: {req.country}")
-        zip_res = requests.get(f"http://api.openweathermap.org/data/2.5/weather?zip={req.zip},{country_code}&appid={API_KEY}").json()
-        if zip_res.get("cod") != 200: raise HTTPException(status_code=400, detail=f"Zip not found: {req.zip} ({zip_res.get('message')})")
-        lat, lon = zip_res['coord']['lat'], zip_res['coord']['lon']
-        location_string = f"{zip_res.get('name')}, {req.zip}"
+        if GAZETTEER is not None:
+            place = GAZETTEER.find_zip(req.zip, country_code)
+            metrics.GAZETTEER_LOOKUPS.inc(kind="zip", result="hit" if place else "miss")
+            if place:
+                return place['lat'], place['lon'], f"{place['name']}, {req.zip}"
+        geo_key = db_cache.geocode_cache_key('zip', req.zip, country_code)
+        geocoded = await asyncio.to_thread(db_cache.get_geocode, geo_key)
+        if geocoded is None:
+            zip_res = await openweather.geocode_zip(req.zip, country_code, API_KEY)
+            if zip_res.get("cod") == 200:
+                geocoded = await asyncio.to_thread(db_cache.set_geocode, geo_key, zip_res['coord']['lat'], zip_res['coord']['lon'], f"{zip_res.get('name')}, {req.zip}")
+            elif str(zip_res.get("cod")) == "404":
+                geocoded = await asyncio.to_thread(db_cache.set_geocode, geo_key, None, None, zip_res.get('message'), found=False)
+            else:
+                raise HTTPException(status_code=400, detail=f"Zip not found: {req.zip} ({zip_res.get('message')})")
+        if not geocoded['found']:
+            raise HTTPException(status_code=400, detail=f"Zip not found: {req.zip} ({geocoded['name']})")
+        return geocoded['lat'], geocoded['lon'], geocoded['name']
     elif req.type == 'gps':
         if req.lat is None or req.lon is None: raise HTTPException(status_code=400, detail="Lat/Lon required for GPS.")
-        lat, lon = req.lat, req.lon
-        location_string = f"GPS_{lat}_{lon}"
+        return req.lat, req.lon, f"GPS_{req.lat}_{req.lon}"
     else: raise HTTPException(status_code=400, detail="Invalid request type.")
 
+@app.post("/api/weather/current")
+async def get_current_weather(req: WeatherRequest, request: Request):
+    lat, lon, location_string = await resolve_location(req)
+
     session_id = "user_session_default"
-    db_cache.log_user_query(session_id, location_string)
+    await asyncio.to_thread(db_cache.log_user_query, session_id, location_string)
 
-    cached_data = db_cache.get_cache(lat, lon, None, location_string)
+    if db_cache.WEATHER_CACHE_STORAGE == 'gzip' and db_cache.WEATHER_CACHE_SPATIAL_MODE == 'exact':
+        # Stored payloads carry the name/coord of exactly these coordinates (see _cache_identity), so hits go out
+        # as stored bytes without a JSON round trip. Snapped modes share rows between locations and need the overlay.
+        payload = await asyncio.to_thread(db_cache.get_cache_payload, lat, lon)
+        if payload is not None:
+            metrics.WEATHER_CACHE_LOOKUPS.inc(result="hit")
+            return _payload_response(*payload, request)
+        cached_data = None # Same lookup as get_cache, so this is already a miss
+    else:
+        cached_data = await asyncio.to_thread(db_cache.get_cache, lat, lon, None, location_string)
     if cached_data:
-        print("Fetching from cache...")
-        if 'name' not in cached_data: cached_data['name'] = location_string
-        if 'coord' not in cached_data: cached_data['coord'] = {'lat': lat, 'lon': lon}
-        return cached_data
+        metrics.WEATHER_CACHE_LOOKUPS.inc(result="hit")
+        return _with_location(cached_data, location_string, lat, lon)
+    stale = await asyncio.to_thread(db_cache.get_stale_cache, lat, lon)
+    if stale:
+        # Serve the expired entry now and refresh it in the background (stale-while-revalidate).
+        metrics.WEATHER_CACHE_LOOKUPS.inc(result="stale")
+        _refresh_in_background(lat, lon, location_string)
+        return _with_location(stale[0], location_string, lat, lon)
     else:
-        print("Fetching from API...")
-        fetched_data = requests.get(f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&exclude=minutely,hourly,alerts&appid={API_KEY}&units=metric").json()
-        if "current" not in fetched_data: raise HTTPException(status_code=500, detail=f"Failed to fetch weather: {fetched_data.get('message')}")
-        fetched_data['name'] = location_string
-        fetched_data['coord'] = {'lat': lat, 'lon': lon}
-        data_ts = fetched_data['current'].get('dt', int(time.time()))
-        db_cache.set_cache(lat, lon, location_string, fetched_data, data_ts)
+        metrics.WEATHER_CACHE_LOOKUPS.inc(result="miss")
+        # Concurrent misses for the same (snapped) coordinates share one upstream fetch.
+        cache_lat, cache_lon = db_cache.snap_coordinates(lat, lon)
+        try:
+            fetched_data = await single_flight.run(("current", cache_lat, cache_lon), lambda: _fetch_current_weather(lat, lon, location_string))
+            return _with_location(dict(fetched_data), location_string, lat, lon) # The result is shared by every caller in the flight
+        except upstream_scheduler.UpstreamUnavailable:
+            stale = await asyncio.to_thread(db_cache.get_stale_cache, lat, lon, STALE_IF_ERROR_SECONDS)
+            if not stale:
+                raise
+            metrics.WEATHER_CACHE_LOOKUPS.inc(result="stale_if_error")
+            return _with_location(stale[0], location_string, lat, lon)
+
+def _payload_response(body, encoding, request: Request):
+    if encoding == 'gzip':
+        if 'gzip' in request.headers.get('accept-encoding', '').lower():
+            return Response(content=body, media_type="application/json", headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+        body = gzip.decompress(body)
+    return Response(content=body, media_type="application/json", headers={"Vary": "Accept-Encoding"})
+
+def _with_location(data, location_string, lat, lon):
+    """Sets the requester's own name/coord on a (copied) cached payload, which may have been stored for another location in the cell."""
+    data['name'] = location_string
+    data['coord'] = {'lat': lat, 'lon': lon}
+    return data
+
+def _cache_identity(lat, lon, location_string):
+    """
+    name/coord stored in a cached payload. In exact mode that is the requested location; when coordinates are
+    snapped, the row serves everyone in the cell, so it gets the cell centre rather than the first requester's position.
+    """
+    if db_cache.WEATHER_CACHE_SPATIAL_MODE == 'exact':
+        return location_string, {'lat': lat, 'lon': lon}
+    cell_lat, cell_lon = db_cache.snap_coordinates(lat, lon)
+    return f"GPS_{cell_lat}_{cell_lon}", {'lat': cell_lat, 'lon': cell_lon}
+
+async def _fetch_current_weather(lat, lon, location_string, force=False):
+    """
+    Fetches and caches current weather, holding a cross-worker lock so only one worker calls upstream per location.
+    Unless force is set, a fresh entry written by another worker while waiting for the lock is returned instead.
+    """
+    lock_name = "weather:{}:{}".format(*db_cache.snap_coordinates(lat, lon))
+    lock_conn = await asyncio.to_thread(db_cache.acquire_advisory_lock, lock_name)
+    try:
+        if lock_conn is not None and not force:
+            # Another worker may have refreshed this location while we waited for the lock.
+            cached_data = await asyncio.to_thread(db_cache.get_cache, lat, lon)
+            if cached_data:
+                return cached_data
+        fetched_data = await _fetch_onecall(lat, lon, location_string)
+        await asyncio.to_thread(db_cache.set_cache, lat, lon, location_string, fetched_data, _data_ts(fetched_data))
         return fetched_data
+    finally:
+        if lock_conn is not None:
+            await asyncio.to_thread(db_cache.release_advisory_lock, lock_conn, lock_name)
+
+async def _fetch_onecall(lat, lon, location_string):
+    """Fetches current weather upstream and returns it, with the cache name/coord, without caching it."""
+    fetched_data = await openweather.fetch_onecall(lat, lon, API_KEY)
+    if "current" not in fetched_data: raise HTTPException(status_code=500, detail=f"Failed to fetch weather: {fetched_data.get('message')}")
+    fetched_data['name'], fetched_data['coord'] = _cache_identity(lat, lon, location_string)
+    return fetched_data
+
+def _data_ts(data):
+    return data['current'].get('dt', int(time.time()))
+
+# Background refresh (stale-while-revalidate and pre-warming of popular locations)
+_background_tasks = set()
+
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "0").lower() in ("1", "true", "yes")
+PREWARM_INTERVAL_SECONDS = int(os.getenv("PREWARM_INTERVAL_SECONDS", "300"))
+PREWARM_LOOKBACK_SECONDS = int(os.getenv("PREWARM_LOOKBACK_SECONDS", "86400")) # Popularity window over user_queries
+PREWARM_TOP_LOCATIONS = int(os.getenv("PREWARM_TOP_LOCATIONS", "50"))
+PREWARM_LEAD_SECONDS = int(os.getenv("PREWARM_LEAD_SECONDS", "900")) # Refresh entries expiring within this window
+PREWARM_MAX_UPSTREAM_CALLS = int(os.getenv("PREWARM_MAX_UPSTREAM_CALLS", "20")) # Upstream budget per cycle
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "5"))
+
+def _start_background_task(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background refresh failed: {task.exception()!r}")
+
+def _refresh_in_background(lat, lon, location_string):
+    key = ("current",) + db_cache.snap_coordinates(lat, lon)
+    if single_flight.is_inflight(key):
+        return # Already being refreshed
+    _start_background_task(single_flight.run(key, lambda: _fetch_in_background(lat, lon, location_string)))
+
+async def _fetch_in_background(lat, lon, location_string, force=False):
+    with upstream_scheduler.priority(upstream_scheduler.BACKGROUND): # Yields upstream capacity to user requests
+        return await _fetch_current_weather(lat, lon, location_string, force=force)
+
+async def prewarm_popular_locations():
+    """
+    Refreshes the most-requested locations whose cache entries are about to expire, spending at most
+    PREWARM_MAX_UPSTREAM_CALLS upstream calls. Only one worker runs a cycle at a time. Returns the number refreshed.
+    """
+    lock_conn = await asyncio.to_thread(db_cache.acquire_advisory_lock, "prewarm", 0)
+    if lock_conn is None:
+        return 0 # Another worker is pre-warming
+    try:
+        now = int(time.time())
+        candidates = await asyncio.to_thread(
+            db_cache.get_prewarm_candidates, now - PREWARM_LOOKBACK_SECONDS, PREWARM_TOP_LOCATIONS, now + PREWARM_LEAD_SECONDS
+        )
+        candidates = candidates[:PREWARM_MAX_UPSTREAM_CALLS]
+        semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+        async def refresh(candidate):
+            lat, lon, location_string = candidate['lat'], candidate['lon'], candidate['location_string']
+            async with semaphore:
+                key = ("current",) + db_cache.snap_coordinates(lat, lon)
+                await single_flight.run(key, lambda: _fetch_in_background(lat, lon, location_string, force=True))
+        outcomes = await asyncio.gather(*(refresh(c) for c in candidates), return_exceptions=True)
+        failures = [o for o in outcomes if isinstance(o, Exception)]
+        for failure in failures:
+            print(f"Pre-warm refresh failed: {failure!r}")
+        print(f"Pre-warmed {len(candidates) - len(failures)} of {len(candidates)} popular locations.")
+        return len(candidates) - len(failures)
+    finally:
+        await asyncio.to_thread(db_cache.release_advisory_lock, lock_conn, "prewarm")
+
+async def _prewarm_loop():
+    while True:
+        await asyncio.sleep(PREWARM_INTERVAL_SECONDS)
+        try:
+            await prewarm_popular_locations()
+        except Exception as e:
+            print(f"Pre-warm cycle failed: {e!r}")
+
+class WeatherHistoryRequest(WeatherRequest):
+    start_date: date
+    end_date: date
+
+HISTORY_MAX_DAYS = int(os.getenv("HISTORY_MAX_DAYS", "31"))
+HISTORY_CONCURRENCY = int(os.getenv("HISTORY_CONCURRENCY", "8")) # Time machine calls in flight per request
+
+def _day_slot(day):
+    """Cache key (data_ts) for a day of history: midnight UTC."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+async def _fetch_history_slot(lat, lon, location_string, slot_ts):
+    fetched_data = await openweather.fetch_timemachine(lat, lon, slot_ts, API_KEY)
+    if "data" not in fetched_data: raise HTTPException(status_code=500, detail=f"Failed to fetch history: {fetched_data.get('message')}")
+    fetched_data['name'], fetched_data['coord'] = _cache_identity(lat, lon, location_string)
+    return fetched_data
+
+@app.post("/api/weather/history")
+async def get_weather_history(req: WeatherHistoryRequest):
+    """
+    Daily weather timeline (one slot per UTC day) for start_date..end_date inclusive.
+    Days already cached are served from weather_cache; only the missing days are fetched from the time machine API,
+    concurrently, and stored with one bulk write, so overlapping ranges only pay for the difference.
+    """
+    if req.end_date < req.start_date:
+        raise HTTPException(status_code=400, detail="end_date must not be before start_date.")
+    if req.end_date > datetime.now(timezone.utc).date():
+        raise HTTPException(status_code=400, detail="end_date must not be in the future.")
+    day_count = (req.end_date - req.start_date).days + 1
+    if day_count > HISTORY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range too long ({day_count} days); the limit is {HISTORY_MAX_DAYS}.")
+
+    lat, lon, location_string = await resolve_location(req)
+    days = [req.start_date + timedelta(days=offset) for offset in range(day_count)]
+    slots = [_day_slot(day) for day in days]
+    await asyncio.to_thread(db_cache.log_user_query, "user_session_default", location_string, start_date=slots[0], end_date=slots[-1])
+
+    cached = await asyncio.to_thread(db_cache.get_cache_for_range, lat, lon, slots[0], slots[-1])
+    missing = [slot for slot in slots if slot not in cached]
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+    cache_lat, cache_lon = db_cache.snap_coordinates(lat, lon)
+
+    async def fetch(slot):
+        async with semaphore:
+            return await single_flight.run(("history", cache_lat, cache_lon, slot), lambda: _fetch_history_slot(lat, lon, location_string, slot))
+    fetched = dict(zip(missing, await asyncio.gather(*(fetch(slot) for slot in missing), return_exceptions=True)))
+    await asyncio.to_thread(
+        db_cache.set_cache_many,
+        [(lat, lon, location_string, data, slot) for slot, data in fetched.items() if not isinstance(data, Exception)],
+        kind='history',
+    )
+
+    timeline = []
+    for day, slot in zip(days, slots):
+        entry = {"dt": slot, "date": day.isoformat()}
+        data = cached.get(slot, fetched.get(slot))
+        if isinstance(data, Exception):
+            entry["error"] = data.detail if isinstance(data, HTTPException) else str(data)
+        else:
+            entry["data"] = _with_location(dict(data), location_string, lat, lon)
+        timeline.append(entry)
+    return {
+        "name": location_string,
+        "coord": {"lat": lat, "lon": lon},
+        "cached_days": len(slots) - len(missing),
+        "fetched_days": sum(1 for data in fetched.values() if not isinstance(data, Exception)),
+        "timeline": timeline,
+    }
+
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600")) # 0 disables background purges
+_last_purge = None
+
+async def _retention_loop():
+    global _last_purge
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+        lock_conn = await asyncio.to_thread(db_cache.acquire_advisory_lock, "retention", 0)
+        if lock_conn is None:
+            continue # Another worker is purging
+        try:
+            _last_purge = {**await asyncio.to_thread(db_cache.purge_weather_cache), "finished_ts": int(time.time())}
+            print(f"weather_cache retention: {_last_purge}")
+        except Exception as e:
+            print(f"weather_cache retention failed: {e!r}")
+        finally:
+            await asyncio.to_thread(db_cache.release_advisory_lock, lock_conn, "retention")
+
+WEATHER_BATCH_MAX_ITEMS = int(os.getenv("WEATHER_BATCH_MAX_ITEMS", "500"))
+WEATHER_BATCH_CONCURRENCY = int(os.getenv("WEATHER_BATCH_CONCURRENCY", "20")) # Upstream calls in flight per batch
+
+def _batch_error(exc):
+    if isinstance(exc, HTTPException):
+        return {"ok": False, "status_code": exc.status_code, "error": exc.detail}
+    if isinstance(exc, upstream_scheduler.UpstreamUnavailable):
+        return {"ok": False, "status_code": 503, "error": str(exc)}
+    return {"ok": False, "status_code": 500, "error": str(exc)}
+
+def _log_queries(session_id, location_strings):
+    for location_string in location_strings:
+        db_cache.log_user_query(session_id, location_string)
+
+@app.post("/api/weather/batch")
+async def get_weather_batch(reqs: list[WeatherRequest] = Body(...)):
+    """
+    Current weather for many locations. Returns one result per item, in order:
+    {"ok": true, "data": {...}} or {"ok": false, "status_code": ..., "error": ...}.
+    Cache lookups are one query for the whole batch; misses are fetched concurrently and written in one statement.
+    """
+    if len(reqs) > WEATHER_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many locations ({len(reqs)}); the limit is {WEATHER_BATCH_MAX_ITEMS}.")
+    semaphore = asyncio.Semaphore(WEATHER_BATCH_CONCURRENCY)
+    results = [None] * len(reqs)
+
+    async def resolve(req):
+        async with semaphore:
+            return await resolve_location(req)
+    resolved = await asyncio.gather(*(resolve(req) for req in reqs), return_exceptions=True)
+
+    session_id = "user_session_default"
+    locations = {}
+    for index, outcome in enumerate(resolved):
+        if isinstance(outcome, Exception):
+            results[index] = _batch_error(outcome)
+        else:
+            locations[index] = outcome
+    await asyncio.to_thread(_log_queries, session_id, [location_string for _, _, location_string in locations.values()])
+
+    cached = await asyncio.to_thread(db_cache.get_cache_many, [(lat, lon) for lat, lon, _ in locations.values()])
+    misses = {} # snapped key -> (lat, lon, location_string) of the first item needing it
+    for index, (lat, lon, location_string) in locations.items():
+        key = db_cache.snap_coordinates(lat, lon)
+        if key in cached:
+            metrics.WEATHER_CACHE_LOOKUPS.inc(result="hit")
+            results[index] = {"ok": True, "data": _with_location(dict(cached[key]), location_string, lat, lon)}
+        else:
+            metrics.WEATHER_CACHE_LOOKUPS.inc(result="miss")
+            misses.setdefault(key, (lat, lon, location_string))
+
+    led = set() # Keys this batch fetched upstream itself, rather than joining another request's flight
+    async def fetch(key, lat, lon, location_string):
+        async def fetch_upstream():
+            led.add(key)
+            return await _fetch_onecall(lat, lon, location_string)
+        async with semaphore:
+            # Same flight key as /api/weather/current, so batch and single-location misses for a cell share one fetch.
+            return await single_flight.run(("current",) + key, fetch_upstream)
+    keys = list(misses)
+    fetched = dict(zip(keys, await asyncio.gather(*(fetch(key, *misses[key]) for key in keys), return_exceptions=True)))
+    to_store = []
+    for key, outcome in fetched.items():
+        # A joined flight's leader caches its own result, which may be an older row it found in the cache; storing
+        # it again here would stamp it with a new fetch_ts.
+        if key in led and not isinstance(outcome, Exception):
+            lat, lon, location_string = misses[key]
+            to_store.append((lat, lon, location_string, outcome, _data_ts(outcome)))
+    await asyncio.to_thread(db_cache.set_cache_many, to_store)
+
+    for index, (lat, lon, location_string) in locations.items():
+        if results[index] is not None:
+            continue
+        outcome = fetched[db_cache.snap_coordinates(lat, lon)]
+        if isinstance(outcome, Exception):
+            results[index] = _batch_error(outcome)
+        else:
+            results[index] = {"ok": True, "data": _with_location(dict(outcome), location_string, lat, lon)}
+    return results
 
 # New Endpoints for Database Management
 
 @app.get("/api/db/tables")
-async def get_db_tables():
+def get_db_tables():
     return db_cache.get_table_names()
 
 @app.get("/api/db/columns/{table_name}")
-async def get_db_columns(table_name: str):
+def get_db_columns(table_name: str):
     return db_cache.get_table_columns(table_name)
 
 @app.get("/api/db/pk_columns/{table_name}")
-async def get_db_pk_columns(table_name: str):
+def get_db_pk_columns(table_name: str):
     return db_cache.get_table_primary_key_columns(table_name)
 
+@app.get("/api/db/stats")
+def get_db_stats():
+    return {"tables": db_cache.get_table_stats(), "last_purge": _last_purge}
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Prometheus text exposition of request, upstream, cache and database metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # New endpoint to get editable columns for a table
 @app.get("/api/db/editable_columns/{table_name}")
 async def get_editable_columns(table_name: str):
     return EDITABLE_TABLE_COLUMNS.get(table_name, [])
 
+DB_DATA_MAX_PAGE_SIZE = 1000
+
 @app.get("/api/db/data/{table_name}")
-async def get_db_table_data(table_name: str, order_by_col: str = Query(None), order_direction: str = "ASC"):
-    return db_cache.get_table_data(table_name, order_by_col, order_direction)
+def get_db_table_data(table_name: str, order_by_col: str = Query(None), order_direction: str = "ASC",
+                      columns: str = Query(None), limit: int = Query(None, ge=1, le=DB_DATA_MAX_PAGE_SIZE),
+                      cursor: str = Query(None), stream: bool = False):
+    """
+    Lists table rows. `columns` is a comma-separated projection (e.g. to leave out weather_cache.data).
+    With `limit`, returns {"rows", "next_cursor"} pages keyed on the primary key; pass next_cursor back as `cursor`.
+    With `stream=true`, streams every row as NDJSON.
+    """
+    column_list = [c.strip() for c in columns.split(',') if c.strip()] if columns else None
+    try:
+        if stream:
+            rows = db_cache.iter_table_data(table_name, order_by_col, order_direction, column_list)
+            return StreamingResponse((json.dumps(row, default=str) + "\n" for row in rows), media_type="application/x-ndjson")
+        return db_cache.get_table_data(table_name, order_by_col, order_direction, column_list, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 class RecordUpdate(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -103,7 +504,7 @@ class RecordUpdate(BaseModel):
     new_value: Any
 
 @app.put("/api/db/record/{table_name}")
-async def update_db_record(table_name: str, req: RecordUpdate):
+def update_db_record(table_name: str, req: RecordUpdate):
     try:
         allowed_cols = EDITABLE_TABLE_COLUMNS.get(table_name)
         if allowed_cols is None:
@@ -123,7 +524,7 @@ class RecordDelete(BaseModel):
     pk_dict: dict
 
 @app.delete("/api/db/record/{table_name}")
-async def delete_db_record(table_name: str, req: RecordDelete):
+def delete_db_record(table_name: str, req: RecordDelete):
     try:
         db_cache.delete_record(table_name, req.pk_dict)
         return {"message": "Record deleted successfully"}
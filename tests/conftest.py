@@ -0,0 +1,39 @@
+# tests/conftest.py
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Repo root: flat modules and utils/
+
+# db_cache reads its configuration at import time: always run against a throwaway embedded SQLite database.
+_DB_DIR = tempfile.mkdtemp(prefix="weather-tests-")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_DB_DIR, "test.sqlite3")
+os.environ["DB_AUTO_MIGRATE"] = "1"
+os.environ["WEATHER_CACHE_SPATIAL_MODE"] = "exact"
+os.environ["WEATHER_CACHE_STORAGE"] = "json"
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_DB_DIR, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def db_dir():
+    return _DB_DIR
+
+@pytest.fixture
+def db(db_dir):
+    """Migrated database with empty data tables and cold in-process caches."""
+    import db_cache
+    import db_migrations
+    db_migrations.migrate()
+    with db_cache.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            for table_name in ("weather_cache", "user_queries", "geocode_cache", "upstream_quota"):
+                cursor.execute(f"DELETE FROM {table_name}")
+        conn.commit()
+    db_cache._weather_l1.clear()
+    db_cache._geocode_l1.clear()
+    return db_cache
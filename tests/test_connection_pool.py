@@ -0,0 +1,99 @@
+# tests/test_connection_pool.py
+import threading
+import time
+
+import pytest
+
+import db_cache
+from db_cache import ConnectionPool, PoolTimeoutError
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        if self.closed:
+            raise ConnectionError("closed")
+
+    def close(self):
+        self.closed = True
+
+def make_pool(max_size=2, timeout=0.2, recycle_seconds=3600, connect=FakeConnection, min_size=0):
+    return ConnectionPool(connect, min_size=min_size, max_size=max_size, timeout=timeout, idle_seconds=300,
+                          recycle_seconds=recycle_seconds, ping_seconds=30)
+
+def test_reuses_released_connections():
+    pool = make_pool()
+    first = pool.acquire()
+    raw = first._conn
+    first.close()
+    first.close() # Idempotent
+    with pool.acquire() as second:
+        assert second._conn is raw
+        assert raw.rollbacks == 1 # Transaction ended on release
+    stats = pool.stats()
+    assert stats["created"] == 1 and stats["size"] == 1 and stats["idle"] == 1 and stats["checked_out"] == 0
+
+def test_times_out_when_exhausted():
+    pool = make_pool(max_size=2, timeout=0.2)
+    held = [pool.acquire(), pool.acquire()]
+    start = time.monotonic()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    assert 0.15 <= time.monotonic() - start < 2
+    assert pool.stats()["size"] == 2 and pool.stats()["waiting"] == 0
+    for conn in held:
+        conn.close()
+
+def test_waiter_gets_connection_released_by_another_thread():
+    pool = make_pool(max_size=1, timeout=5)
+    held = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.1)
+    assert not acquired and pool.stats()["waiting"] == 1
+    held.close()
+    waiter.join(2)
+    assert len(acquired) == 1
+    acquired[0].close()
+
+def test_discard_and_recycle_close_connections():
+    pool = make_pool(recycle_seconds=0)
+    conn = pool.acquire()
+    raw = conn._conn
+    time.sleep(0.01)
+    conn.close() # Older than recycle_seconds
+    assert raw.closed and pool.stats()["size"] == 0
+
+    pool = make_pool()
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.discard()
+    stats = pool.stats()
+    assert raw.closed and stats["size"] == 0 and stats["checked_out"] == 0
+
+def test_failed_connect_frees_its_slot():
+    attempts = []
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("refused")
+        return FakeConnection()
+    pool = make_pool(max_size=1, connect=connect)
+    with pytest.raises(ConnectionError):
+        pool.acquire()
+    with pool.acquire():
+        pass
+    assert pool.stats()["size"] == 1
+
+def test_sqlite_pool_round_trip(db):
+    with db.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT %s AS answer", (42,))
+            assert cursor.fetchone() == {"answer": 42}
+    assert db_cache.get_pool_stats()["checked_out"] == 0
@@ -0,0 +1,135 @@
+# tests/test_db_cache.py
+import os
+import time
+
+import pytest
+
+import db_migrations
+
+def _store(db, count, loc=lambda i: f"L{i}"):
+    for i in range(count):
+        db.set_cache(float(i), float(i), loc(i), {"i": i}, 1000 + i)
+
+def _all_pages(db, table_name, order_by, direction, columns=None, limit=2):
+    rows, token, pages = [], None, 0
+    while True:
+        page = db.get_table_data(table_name, order_by, direction, columns, limit, token)
+        rows += page["rows"]
+        pages += 1
+        token = page["next_cursor"]
+        if token is None or pages > 50:
+            return rows
+
+def test_migrate_is_idempotent(db):
+    assert db_migrations.migrate() == db_migrations.LATEST_SCHEMA_VERSION
+    assert db_migrations.migrate() == db_migrations.LATEST_SCHEMA_VERSION
+    assert db_migrations.get_schema_version() == db_migrations.LATEST_SCHEMA_VERSION
+    with db.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) AS n FROM schema_version")
+            assert cursor.fetchone()["n"] == len(db_migrations.MIGRATIONS)
+    db.init_db() # Up to date: a single version query
+
+def test_each_migration_is_idempotent_on_its_own(db):
+    with db.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            for _, _, migration in db_migrations.MIGRATIONS:
+                migration(cursor) # Already applied: must be a no-op
+            conn.commit()
+    assert db.get_table_primary_key_columns("user_queries") == ["id"]
+
+@pytest.mark.parametrize("direction", ["ASC", "DESC"])
+@pytest.mark.parametrize("order_by", [None, "loc", "data_ts", "lat"])
+def test_table_paging_matches_unpaged_order_with_nulls(db, order_by, direction):
+    _store(db, 7, loc=lambda i: None if i % 3 == 0 else f"L{i % 2}") # NULLs and duplicates in the order column
+    expected = db.get_table_data("weather_cache", order_by, direction, ["loc"])
+    rows = _all_pages(db, "weather_cache", order_by, direction, ["loc"])
+    key = lambda row: (row["lat"], row["lon"], row["data_ts"])
+    assert [key(r) for r in rows] == [key(r) for r in expected]
+    assert len(expected) == 7
+
+@pytest.mark.parametrize("direction", ["ASC", "DESC"])
+def test_table_paging_in_gzip_mode_orders_on_stored_values(db, monkeypatch, direction):
+    monkeypatch.setattr(db, "WEATHER_CACHE_STORAGE", "gzip")
+    _store(db, 5)
+    rows = _all_pages(db, "weather_cache", "data", direction, limit=2) # `data` is NULL in every row
+    assert sorted(r["loc"] for r in rows) == [f"L{i}" for i in range(5)]
+    assert all(r["data"].startswith("{") and r["data_gz"].startswith("<gzip") for r in rows)
+
+def test_table_paging_rejects_bad_cursor(db):
+    with pytest.raises(ValueError):
+        db.get_table_data("weather_cache", None, "ASC", None, 2, "not-a-cursor")
+
+def test_get_cache_many_uses_one_lookup_and_l1(db):
+    _store(db, 3)
+    found = db.get_cache_many([(0.0, 0.0), (1.0, 1.0), (1.0, 1.0), (9.0, 9.0)])
+    assert found == {(0.0, 0.0): {"i": 0}, (1.0, 1.0): {"i": 1}}
+    found[(0.0, 0.0)]["name"] = "mutated" # Callers get copies
+    hits = db.get_l1_cache_stats()["hits"]
+    assert db.get_cache_many([(0.0, 0.0)]) == {(0.0, 0.0): {"i": 0}}
+    assert db.get_l1_cache_stats()["hits"] == hits + 1
+    assert db.get_cache(2.0, 2.0) == {"i": 2}
+
+def test_l1_charges_decompressed_size_in_gzip_mode(db, monkeypatch):
+    monkeypatch.setattr(db, "WEATHER_CACHE_STORAGE", "gzip")
+    payload = {"text": "x" * 10000}
+    db.set_cache(3.0, 3.0, "G", payload, 1000)
+    db.set_cache(4.0, 4.0, "G", payload, 1000)
+    bytes_before = db.get_l1_cache_stats()["bytes"]
+    db.get_cache(3.0, 3.0)
+    db.get_cache_many([(4.0, 4.0)])
+    assert db.get_l1_cache_stats()["bytes"] - bytes_before >= 2 * len(db.json.dumps(payload, separators=(',', ':')))
+
+def test_history_rows_are_not_current_weather(db):
+    db.set_cache_many([(5.0, 5.0, "H", {"day": 1}, 86400)], kind='history')
+    assert db.get_cache_many([(5.0, 5.0)]) == {}
+    db.set_cache(5.0, 5.0, "H", {"now": 1}, 90000)
+    assert db.get_cache_for_range(5.0, 5.0, 0, 10 ** 6) == {86400: {"day": 1}}
+
+def test_keep_latest_applies_per_kind(db):
+    db.set_cache_many([(5.0, 5.0, "H", {"day": day}, day * 86400) for day in range(1, 11)], kind='history')
+    db.set_cache(5.0, 5.0, "H", {"now": 1}, 20 * 86400)
+    result = db.purge_weather_cache(retention_seconds=0, keep_latest=3, pause_seconds=0)
+    assert result["excess"] == 7
+    assert sorted(db.get_cache_for_range(5.0, 5.0, 0, 30 * 86400)) == [8 * 86400, 9 * 86400, 10 * 86400]
+    assert db.get_cache(5.0, 5.0) == {"now": 1}
+
+@pytest.mark.parametrize("action", ["update", "delete"])
+def test_admin_edits_invalidate_nearest_row_fallbacks(db, monkeypatch, action):
+    monkeypatch.setattr(db, "WEATHER_CACHE_SPATIAL_MODE", "grid")
+    db.set_cache(51.50, -0.12, "London", {"v": 1}, 1000)
+    assert db.get_cache(51.50, -0.13) == {"v": 1} # Served from the neighbouring cell's row, now in L1
+    pk = {"lat": 51.5, "lon": -0.12, "data_ts": 1000}
+    if action == "update":
+        db.update_record("weather_cache", pk, "data", {"v": 2})
+        assert db.get_cache(51.50, -0.13) == {"v": 2}
+    else:
+        db.delete_record("weather_cache", pk)
+        assert db.get_cache(51.50, -0.13) is None
+
+def test_user_queries_keep_every_row(db):
+    now = int(time.time())
+    db._insert_user_queries([("s", now, f"L{i}", None, None) for i in range(5)])
+    db.log_user_query("s", "L0", query_ts=now)
+    assert sorted(r["location_string"] for r in db.get_all_user_queries()) == ["L0", "L0", "L1", "L2", "L3", "L4"]
+
+def test_prewarm_ranks_by_query_count(db):
+    now = int(time.time())
+    db.set_cache(1.0, 1.0, "A", {"a": 1}, 1)
+    db.set_cache(2.0, 2.0, "B", {"b": 1}, 1)
+    db._insert_user_queries([("s", now, "A", None, None)] * 3 + [("s", now, "B", None, None)])
+    candidates = db.get_prewarm_candidates(now - 60, 10, now + 10 ** 6)
+    assert [(c["location_string"], c["hits"]) for c in candidates] == [("A", 3), ("B", 1)]
+
+def test_advisory_locks_exclude_and_leave_no_files(db, db_dir):
+    handle = db.acquire_advisory_lock("weather:1.0:2.0", timeout=1)
+    assert handle is not None
+    assert db.acquire_advisory_lock("weather:1.0:2.0", timeout=0) is None
+    other = db.acquire_advisory_lock("weather:3.0:4.0", timeout=0)
+    assert other is not None
+    db.release_advisory_lock(other, "weather:3.0:4.0")
+    db.release_advisory_lock(handle, "weather:1.0:2.0")
+    for i in range(20):
+        name = f"weather:{i}:{i}"
+        db.release_advisory_lock(db.acquire_advisory_lock(name, timeout=1), name)
+    assert [f for f in os.listdir(db_dir) if f.endswith(".lock")] == []
@@ -0,0 +1,69 @@
+# tests/test_gazetteer.py
+import pytest
+
+from COUNTRIES import COUNTRIES
+from utils import gazetteer
+
+# geonameid, name, asciiname, alternatenames, lat, lon, feature class, feature code, country, cc2, admin1, ..., population
+CITIES = [
+    ("2643743", "London", "London", "51.50853", "-0.12574", "GB", "ENG", 8961989),
+    ("6058560", "London", "London", "42.98339", "-81.23304", "CA", "08", 383822),
+    ("4517009", "London", "London", "39.88645", "-83.44825", "US", "OH", 10060),
+    ("3448439", "São Paulo", "Sao Paulo", "-23.5475", "-46.63611", "BR", "27", 10021295),
+    ("1264523", "Lonavala", "Lonavala", "18.75", "73.4", "IN", "16", 57698),
+    ("2314302", "Kinshasa", "Kinshasa", "-4.32758", "15.31357", "CD", "06", 7785965),
+    ("3093133", "Łódź", "Lodz", "51.75", "19.46667", "PL", "74", 768755),
+]
+ADMIN1 = [("GB.ENG", "England"), ("CA.08", "Ontario"), ("US.OH", "Ohio"), ("BR.27", "Sao Paulo"), ("IN.16", "Maharashtra"),
+          ("CD.06", "Kinshasa"), ("PL.74", "Łódź Voivodeship")]
+ZIPS = [("IN", "110001", "New Delhi", "Delhi", "28.6", "77.2"), ("US", "94040", "Mountain View", "California", "37.38", "-122.08")]
+
+@pytest.fixture(scope="module")
+def gaz(tmp_path_factory):
+    root = tmp_path_factory.mktemp("gazetteer")
+    with open(root / "cities.txt", "w", encoding="utf-8") as f:
+        for gid, name, ascii_name, lat, lon, cc, admin1, population in CITIES:
+            f.write("\t".join([gid, name, ascii_name, "", lat, lon, "P", "PPL", cc, "", admin1, "", "", "", str(population),
+                               "", "", "", "2024-01-01"]) + "\n")
+    with open(root / "admin1.txt", "w", encoding="utf-8") as f:
+        f.writelines(f"{code}\t{name}\t{name}\t0\n" for code, name in ADMIN1)
+    with open(root / "zips.txt", "w", encoding="utf-8") as f:
+        f.writelines(f"{cc}\t{code}\t{place}\t{admin}\t\t\t\t\t\t{lat}\t{lon}\t4\n" for cc, code, place, admin, lat, lon in ZIPS)
+    counts = gazetteer.build(str(root / "idx"), str(root / "cities.txt"), str(root / "admin1.txt"), str(root / "zips.txt"))
+    assert counts[gazetteer.CITIES_FILE] == len(CITIES) + 1 # Łódź is indexed under both 'łodz' and 'lodz'
+    g = gazetteer.open_gazetteer(str(root / "idx"), {code.upper(): name for name, code in COUNTRIES.items()})
+    yield g
+    g.close()
+
+def test_find_city_prefers_population_and_honours_country(gaz):
+    assert gaz.find_city("london")["country"] == "GB"
+    assert gaz.find_city("London, CA")["state"] == "Ontario"
+    assert gaz.find_city("  sao   paulo ")["name"] == "São Paulo"
+    assert gaz.find_city("Nowhere") is None
+    assert gaz.find_city("London, FR") is None
+
+def test_find_city_accepts_state_and_country_names(gaz):
+    assert gaz.find_city("London, Ontario, Canada")["country"] == "CA"
+    assert gaz.find_city("London, Ohio")["country"] == "US"
+    assert gaz.find_city("London, England, United Kingdom")["country"] == "GB"
+    assert gaz.find_city("Kinshasa, Kinshasa, Congo, Democratic Republic of the")["country"] == "CD"
+    assert gaz.find_city("London, Texas, United States of America") is None
+
+@pytest.mark.parametrize("prefix", ["l", "lo", "lon", "lond", "london", "s", "sao p", "ki", "lodz", "łó"])
+def test_every_suggestion_resolves_to_the_suggested_city(gaz, prefix):
+    suggestions = gaz.suggest(prefix)
+    assert suggestions
+    for text in suggestions:
+        city = gaz.find_city(text)
+        assert city is not None, text
+        assert gaz.suggestion_text(city) == text
+
+def test_suggest_orders_by_population_and_limits(gaz):
+    assert gaz.suggest("lo", limit=5)[:3] == ["London, England, United Kingdom", "Łódź, Łódź Voivodeship, Poland", "London, Ontario, Canada"]
+    assert len(gaz.suggest("l", limit=2)) == 2
+    assert gaz.suggest("zz") == [] and gaz.suggest("") == []
+
+def test_find_zip(gaz):
+    assert gaz.find_zip("110001", "in")["name"] == "New Delhi"
+    assert gaz.find_zip(" 94040 ", "US")["lat"] == pytest.approx(37.38)
+    assert gaz.find_zip("94040", "IN") is None
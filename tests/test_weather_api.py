@@ -0,0 +1,89 @@
+# tests/test_weather_api.py
+import asyncio
+import gzip
+import json
+
+import httpx
+import pytest
+
+import main
+from bench.fake_upstreams import FakeUpstreams
+from utils import http_client, openweather
+
+@pytest.fixture(scope="module")
+def upstreams():
+    fake = FakeUpstreams(latency_ms=100).start()
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def api(db, upstreams, monkeypatch):
+    monkeypatch.setattr(openweather, "OPENWEATHER_BASE_URL", upstreams.base_url)
+    monkeypatch.setattr(main, "API_KEY", "test")
+    upstreams.reset()
+
+    def run(*requests):
+        """Sends (method, path, json) requests concurrently; returns the responses in order."""
+        async def send_all():
+            transport = httpx.ASGITransport(app=main.app)
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    return await asyncio.gather(*(client.request(method, path, json=body) for method, path, body in requests))
+            finally:
+                await http_client.close_client() # The shared upstream client is bound to this event loop
+        return asyncio.run(send_all())
+    return run
+
+def test_snapped_cell_never_returns_another_requesters_location(api, upstreams, db, monkeypatch):
+    monkeypatch.setattr(db, "WEATHER_CACHE_SPATIAL_MODE", "geohash")
+    monkeypatch.setattr(db, "WEATHER_CACHE_STORAGE", "gzip")
+    first, second = {"type": "gps", "lat": 51.50741, "lon": -0.12781}, {"type": "gps", "lat": 51.5075, "lon": -0.1279}
+    (a,) = api(("POST", "/api/weather/current", first))
+    (b,) = api(("POST", "/api/weather/current", second)) # Same geohash cell: a cache hit
+    assert upstreams.stats()["calls"].get("onecall") == 1
+    assert a.json()["coord"] == {"lat": 51.50741, "lon": -0.12781} and a.json()["name"] == "GPS_51.50741_-0.12781"
+    assert b.json()["coord"] == {"lat": 51.5075, "lon": -0.1279} and b.json()["name"] == "GPS_51.5075_-0.1279"
+
+    body, encoding = db.get_cache_payload(51.5075, -0.1279)
+    stored = json.loads(gzip.decompress(body))
+    cell_lat, cell_lon = db.snap_coordinates(51.5075, -0.1279)
+    assert stored["coord"] == {"lat": cell_lat, "lon": cell_lon} and stored["name"] == f"GPS_{cell_lat}_{cell_lon}"
+
+def test_concurrent_followers_get_their_own_location(api, upstreams, db, monkeypatch):
+    monkeypatch.setattr(db, "WEATHER_CACHE_SPATIAL_MODE", "grid")
+    bodies = [{"type": "gps", "lat": 10.001 + i / 10000, "lon": 20.001} for i in range(3)] # One 0.01° grid cell
+    responses = api(*(("POST", "/api/weather/current", body) for body in bodies))
+    assert upstreams.stats()["calls"].get("onecall") == 1
+    assert [r.json()["coord"]["lat"] for r in responses] == [body["lat"] for body in bodies]
+
+def test_batch_and_current_misses_share_one_fetch(api, upstreams, db):
+    here, there = {"type": "gps", "lat": 10.0, "lon": 20.0}, {"type": "gps", "lat": 11.0, "lon": 21.0}
+    current, batch = api(("POST", "/api/weather/current", here), ("POST", "/api/weather/batch", [here, there, here]))
+    assert current.status_code == 200 and [item["ok"] for item in batch.json()] == [True, True, True]
+    assert upstreams.stats()["calls"].get("onecall") == 2 # One per location
+    assert sorted(r["location_string"] for r in db.get_all_user_queries()) == ["GPS_10.0_20.0"] * 3 + ["GPS_11.0_21.0"]
+
+def test_batch_does_not_restore_joined_flights(api, upstreams, db):
+    here, there = {"type": "gps", "lat": 10.0, "lon": 20.0}, {"type": "gps", "lat": 11.0, "lon": 21.0}
+    cached_elsewhere = {"current": {"dt": 1}, "name": "GPS_10.0_20.0", "coord": {"lat": 10.0, "lon": 20.0}}
+
+    async def leader():
+        await asyncio.sleep(0.3)
+        return cached_elsewhere
+
+    async def scenario():
+        flight = asyncio.create_task(main.single_flight.run(("current", 10.0, 20.0), leader))
+        await asyncio.sleep(0) # Register the flight before the batch misses on it
+        transport = httpx.ASGITransport(app=main.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                response = await client.post("/api/weather/batch", json=[here, there])
+        finally:
+            await http_client.close_client()
+        await flight
+        return response
+    response = asyncio.run(scenario())
+    assert response.json()[0]["data"]["current"]["dt"] == 1
+    assert upstreams.stats()["calls"].get("onecall") == 1 # Only the location the batch led
+    # The joined leader's result (here: a row another worker cached earlier) isn't re-stored with a new fetch_ts
+    assert db.get_cache(10.0, 20.0) is None and db.get_cache(11.0, 21.0) is not None
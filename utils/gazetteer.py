@@ -0,0 +1,305 @@
+# utils/gazetteer.py
+"""
+Offline gazetteer: city / zip geocoding and city-name autocomplete from local, memory-mapped index files,
+built from the GeoNames dumps (https://download.geonames.org/export/dump/ and /export/zip/).
+
+    python -m utils.gazetteer build --out gazetteer \\
+        --cities cities15000.zip --admin1 admin1CodesASCII.txt --zips allCountries.zip
+
+Each index file is a sorted array of `key\\tfield\\tfield...` records with an offset table, searched by binary
+search straight from the mmap, so opening is instant and memory is shared between workers:
+  cities.idx  - normalized city name -> place (same-name places ordered by population, largest first)
+  zips.idx    - 'CC:ZIP' -> place; each country's codes are contiguous
+  prefix.idx  - 1..PREFIX_INDEX_MAX_LEN character name prefix -> most populous matching cities
+Rebuilding replaces the files atomically; running workers keep the old index until they reopen it.
+"""
+import argparse
+import csv
+import heapq
+import io
+import mmap
+import os
+import struct
+import sys
+import unicodedata
+import zipfile
+
+MAGIC = b"GAZIDX1\n"
+HEADER = struct.Struct("<8sQ") # magic, record count; followed by count + 1 uint64 record offsets
+CITIES_FILE, ZIPS_FILE, PREFIX_FILE = "cities.idx", "zips.idx", "prefix.idx"
+PREFIX_INDEX_MAX_LEN = 3 # Longer prefixes are answered by scanning cities.idx, whose matching range is then small
+PREFIX_SCAN_LIMIT = 2000 # Max cities.idx records examined for a longer prefix
+SUGGESTIONS_PER_PREFIX = 5
+
+def normalize_name(text):
+    """Case- and accent-insensitive form used for keys: 'São  Paulo' -> 'sao paulo'."""
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.replace(",", " ").split()).casefold()
+
+def zip_key(zip_code, country_code):
+    return f"{str(country_code).strip().upper()}:{' '.join(str(zip_code).split()).upper()}"
+
+class SortedIndex:
+    """Read-only view of one index file: records sorted by key bytes, addressed through the offset table."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gazetteer index file")
+        table_end = HEADER.size + 8 * (self.count + 1)
+        self._offsets = memoryview(self._mmap)[HEADER.size:table_end].cast("Q")
+        self._base = table_end
+
+    def __len__(self):
+        return self.count
+
+    def _record_bytes(self, i):
+        return self._mmap[self._base + self._offsets[i]:self._base + self._offsets[i + 1]]
+
+    def key(self, i):
+        record = self._record_bytes(i)
+        tab = record.find(b"\t")
+        return record if tab == -1 else record[:tab]
+
+    def fields(self, i):
+        """Returns the record's fields after the key, decoded."""
+        return self._record_bytes(i).decode().split("\t")[1:]
+
+    def bisect_left(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def equal_range(self, key):
+        key = key.encode()
+        return self.bisect_left(key), self.bisect_left(key + b"\t") # '\t' sorts right after the key itself
+
+    def prefix_range(self, prefix):
+        prefix = prefix.encode()
+        return self.bisect_left(prefix), self.bisect_left(prefix + b"\xff") # 0xff never occurs in UTF-8
+
+    def close(self):
+        self._offsets.release()
+        self._mmap.close()
+
+class Gazetteer:
+    """City / zip lookups and autocomplete over the index files in `directory`. Lookups return None on a miss."""
+    def __init__(self, directory, country_names=None):
+        self.directory = directory
+        self.country_names = country_names or {} # 'GB' -> 'United Kingdom', for suggestion text
+        self._country_codes = {normalize_name(name): code for code, name in self.country_names.items()}
+        self.cities = SortedIndex(os.path.join(directory, CITIES_FILE))
+        self.prefixes = SortedIndex(os.path.join(directory, PREFIX_FILE))
+        zips_path = os.path.join(directory, ZIPS_FILE)
+        self.zips = SortedIndex(zips_path) if os.path.exists(zips_path) else None
+
+    def _city(self, i):
+        geoname_id, name, lat, lon, country, admin1, population = self.cities.fields(i)
+        return {"id": geoname_id, "name": name, "lat": float(lat), "lon": float(lon), "country": country,
+                "state": admin1, "population": int(population or 0)}
+
+    def _interpretations(self, qualifiers):
+        """
+        (state, country code) readings of the parts after the name: a trailing ISO code or country name (which may
+        itself contain commas), preceded by an optional state. Without a recognizable country, everything is the state.
+        """
+        readings = []
+        for k in range(len(qualifiers)):
+            tail = ", ".join(qualifiers[k:])
+            code = self._country_codes.get(normalize_name(tail))
+            if code is None and k == len(qualifiers) - 1 and len(tail) == 2:
+                code = tail.upper()
+            if code:
+                readings.append((", ".join(qualifiers[:k]) or None, code))
+        readings.append((", ".join(qualifiers) or None, None))
+        return readings
+
+    def find_city(self, query):
+        """
+        Resolves 'Name', 'Name, CC' (ISO country code) or 'Name, State, Country' (the suggestion_text format)
+        to the most populous matching city: {'name', 'lat', 'lon', 'country', 'state', ...} or None.
+        """
+        parts = [part.strip() for part in str(query).split(",") if part.strip()]
+        if not parts:
+            return None
+        lo, hi = self.cities.equal_range(normalize_name(parts[0]))
+        cities = [self._city(i) for i in range(lo, hi)]
+        for state, country in self._interpretations(parts[1:]):
+            for city in cities:
+                if (country is None or city["country"] == country) and (state is None or normalize_name(state) == normalize_name(city["state"])):
+                    return city
+        return None
+
+    def find_zip(self, zip_code, country_code):
+        """Resolves a postal code in a country to {'name', 'lat', 'lon', 'state'} or None."""
+        if self.zips is None:
+            return None
+        lo, hi = self.zips.equal_range(zip_key(zip_code, country_code))
+        if lo == hi:
+            return None
+        name, lat, lon, admin1 = self.zips.fields(lo)
+        return {"name": name, "lat": float(lat), "lon": float(lon), "state": admin1}
+
+    def suggestion_text(self, city):
+        """'Name, State, Country', like the Places autocomplete 'main, secondary' text."""
+        parts = [city["name"], city["state"], self.country_names.get(city["country"], city["country"])]
+        return ", ".join(part for part in parts if part)
+
+    def suggest(self, query, limit=SUGGESTIONS_PER_PREFIX):
+        """Up to `limit` city suggestions for a name prefix, most populous first."""
+        prefix = normalize_name(query)
+        if not prefix:
+            return []
+        if len(prefix) <= PREFIX_INDEX_MAX_LEN:
+            lo, hi = self.prefixes.equal_range(prefix)
+            indices = [int(i) for i in self.prefixes.fields(lo)[0].split()] if lo < hi else []
+            cities = [self._city(i) for i in indices]
+        else:
+            lo, hi = self.cities.prefix_range(prefix)
+            best = {}
+            for i in range(lo, min(hi, lo + PREFIX_SCAN_LIMIT)):
+                city = self._city(i)
+                if city["id"] not in best:
+                    best[city["id"]] = city
+            cities = heapq.nlargest(limit, best.values(), key=lambda c: c["population"])
+        suggestions = []
+        for city in cities:
+            text = self.suggestion_text(city)
+            if text not in suggestions:
+                suggestions.append(text)
+        return suggestions[:limit]
+
+    def close(self):
+        for index in (self.cities, self.prefixes, self.zips):
+            if index is not None:
+                index.close()
+
+def open_gazetteer(directory, country_names=None):
+    """Opens the gazetteer in `directory`, or returns None (with a message) if it hasn't been built there."""
+    try:
+        return Gazetteer(directory, country_names)
+    except (OSError, ValueError) as e:
+        print(f"Offline gazetteer unavailable in '{directory}': {e}")
+        return None
+
+# Building
+
+def _open_text(path):
+    """Opens a GeoNames .txt dump, or the .txt member of its .zip download, as text."""
+    if path.endswith(".zip"):
+        archive = zipfile.ZipFile(path)
+        member = next(name for name in archive.namelist() if name.endswith(".txt") and not name.lower().startswith("readme"))
+        return io.TextIOWrapper(archive.open(member), encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+def _rows(path):
+    with _open_text(path) as f:
+        yield from csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+
+def _clean(value):
+    return " ".join(str(value).replace("\t", " ").split())
+
+def write_index(path, records):
+    """Writes (key, fields) records, sorted by key bytes (stable for equal keys), as an index file; atomic replace."""
+    encoded = sorted(((key.encode(), "\t".join([key] + [_clean(f) for f in fields]).encode()) for key, fields in records),
+                     key=lambda item: item[0])
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(encoded)))
+        offset, offsets = 0, [0]
+        for _, record in encoded:
+            offset += len(record)
+            offsets.append(offset)
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        for _, record in encoded:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(encoded)
+
+def build(out_dir, cities_path, admin1_path=None, zips_path=None, min_population=0):
+    """Builds the index files in out_dir from GeoNames dumps. Returns {file: record count}."""
+    os.makedirs(out_dir, exist_ok=True)
+    admin1 = {}
+    if admin1_path:
+        for row in _rows(admin1_path):
+            if len(row) >= 2:
+                admin1[row[0]] = row[1] # 'US.CA' -> 'California'
+
+    cities = []
+    for row in _rows(cities_path):
+        if len(row) < 15 or row[6] != "P": # Populated places only
+            continue
+        population = int(row[14] or 0)
+        if population < min_population:
+            continue
+        fields = [row[0], row[1], row[4], row[5], row[8], admin1.get(f"{row[8]}.{row[10]}", ""), population]
+        for key in {normalize_name(row[1]), normalize_name(row[2])} - {""}:
+            cities.append((key, -population, fields))
+    cities.sort(key=lambda c: (c[0].encode(), c[1])) # Same-name places: most populous first
+    counts = {CITIES_FILE: write_index(os.path.join(out_dir, CITIES_FILE), [(key, fields) for key, _, fields in cities])}
+
+    # Top cities per short prefix, as indices into cities.idx (whose order matches `cities` above)
+    top = {}
+    for index, (key, negative_population, fields) in enumerate(cities):
+        for length in range(1, min(PREFIX_INDEX_MAX_LEN, len(key)) + 1):
+            entries = top.setdefault(key[:length], {})
+            geoname_id = fields[0]
+            if geoname_id not in entries:
+                entries[geoname_id] = (-negative_population, index)
+                if len(entries) > SUGGESTIONS_PER_PREFIX * 4: # Bound memory; keep the most populous
+                    for dropped, _ in heapq.nsmallest(len(entries) - SUGGESTIONS_PER_PREFIX, entries.items(), key=lambda e: e[1]):
+                        del entries[dropped]
+    prefix_records = []
+    for prefix, entries in top.items():
+        best = heapq.nlargest(SUGGESTIONS_PER_PREFIX, entries.values())
+        prefix_records.append((prefix, [" ".join(str(index) for _, index in best)]))
+    counts[PREFIX_FILE] = write_index(os.path.join(out_dir, PREFIX_FILE), prefix_records)
+
+    if zips_path:
+        zips = {}
+        for row in _rows(zips_path):
+            if len(row) >= 11 and row[9] and row[10]:
+                zips.setdefault(zip_key(row[1], row[0]), [row[2], row[9], row[10], row[3]]) # First place per code
+        counts[ZIPS_FILE] = write_index(os.path.join(out_dir, ZIPS_FILE), zips.items())
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the offline gazetteer.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Build index files from GeoNames dumps.")
+    build_parser.add_argument("--out", required=True, help="Output directory (GAZETTEER_DIR).")
+    build_parser.add_argument("--cities", required=True, help="citiesNNNNN.txt / .zip or allCountries dump.")
+    build_parser.add_argument("--admin1", help="admin1CodesASCII.txt, for state / region names.")
+    build_parser.add_argument("--zips", help="Postal code dump (export/zip/allCountries.zip or a country file).")
+    build_parser.add_argument("--min-population", type=int, default=0)
+    query_parser = commands.add_parser("query", help="Look up a city, zip (--country) or prefix (--suggest).")
+    query_parser.add_argument("--dir", required=True)
+    query_parser.add_argument("text")
+    query_parser.add_argument("--country", help="Country code, to look `text` up as a zip code.")
+    query_parser.add_argument("--suggest", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        counts = build(args.out, args.cities, args.admin1, args.zips, args.min_population)
+        for name, count in counts.items():
+            print(f"{name}: {count} records")
+        return
+    gazetteer = open_gazetteer(args.dir)
+    if gazetteer is None:
+        sys.exit(1)
+    if args.suggest:
+        print(gazetteer.suggest(args.text))
+    elif args.country:
+        print(gazetteer.find_zip(args.text, args.country))
+    else:
+        print(gazetteer.find_city(args.text))
+
+if __name__ == "__main__":
+    main()
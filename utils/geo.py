@@ -0,0 +1,72 @@
+# utils/geo.py
+import math
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_BASE32_INDEX = {c: i for i, c in enumerate(_BASE32)}
+
+EARTH_RADIUS_KM = 6371.0
+
+def geohash_encode(lat, lon, precision=6):
+    """Encodes a coordinate as a geohash string of `precision` characters."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if coord >= mid:
+            value = (value << 1) | 1
+            rng[0] = mid
+        else:
+            value <<= 1
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+def geohash_bounds(geohash):
+    """Returns (min_lat, max_lat, min_lon, max_lon) of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+def geohash_center(geohash):
+    min_lat, max_lat, min_lon, max_lon = geohash_bounds(geohash)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+def geohash_neighbors(geohash):
+    """Returns the cell itself plus its (up to) 8 surrounding cells at the same precision."""
+    min_lat, max_lat, min_lon, max_lon = geohash_bounds(geohash)
+    lat_step, lon_step = max_lat - min_lat, max_lon - min_lon
+    center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    cells = []
+    for dlat in (-1, 0, 1):
+        lat = center_lat + dlat * lat_step
+        if not -90.0 <= lat <= 90.0:
+            continue
+        for dlon in (-1, 0, 1):
+            lon = (center_lon + dlon * lon_step + 180.0) % 360.0 - 180.0 # Wrap around the antimeridian
+            cell = geohash_encode(lat, lon, len(geohash))
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two coordinates in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
@@ -1,20 +1,70 @@
 # utils/google_places.py
-import requests
 import os
 
+import httpx
+
+from utils import http_client, upstream_scheduler
+from utils.lru_cache import TTLCache
+
+GOOGLE_PLACES_BASE_URL = os.getenv("GOOGLE_PLACES_BASE_URL", "https://places.googleapis.com")
+
+# Autocomplete cache, keyed on (types, normalized query)
+AUTOCOMPLETE_CACHE_TTL_SECONDS = int(os.getenv("AUTOCOMPLETE_CACHE_TTL_SECONDS", "86400"))
+AUTOCOMPLETE_CACHE_MAX_ENTRIES = int(os.getenv("AUTOCOMPLETE_CACHE_MAX_ENTRIES", "5000"))
+AUTOCOMPLETE_MAX_RESULTS = 5 # Places autocomplete returns at most 5 predictions, so a full list may be truncated
+
+_autocomplete_cache = TTLCache(AUTOCOMPLETE_CACHE_MAX_ENTRIES, default_ttl=AUTOCOMPLETE_CACHE_TTL_SECONDS)
+
+def _normalize(text):
+    return " ".join(text.replace(",", " ").split()).lower()
+
+def _matches_prefix(suggestion, normalized_query):
+    # Places matches the input against the start of any word in the place's text
+    return f" {_normalize(suggestion)}".find(f" {normalized_query}") != -1
+
+def _cached_suggestions(types_key, normalized_query):
+    """
+    Returns cached suggestions for the query, or None on a miss.
+    If the query itself isn't cached, walks back through its shorter prefixes: an untruncated result list
+    for "lon" contains every match for "lond", so it can be filtered locally instead of calling upstream.
+    """
+    suggestions = _autocomplete_cache.get((types_key, normalized_query))
+    if suggestions is not None:
+        return suggestions
+    for end in range(len(normalized_query) - 1, 0, -1):
+        entry = _autocomplete_cache.get_with_expiry((types_key, normalized_query[:end]))
+        if entry is not None and len(entry[0]) < AUTOCOMPLETE_MAX_RESULTS:
+            shorter, expires_at = entry
+            suggestions = [s for s in shorter if _matches_prefix(s, normalized_query)]
+            # The derived list is only as fresh as its source, so it expires with it
+            _autocomplete_cache.set((types_key, normalized_query), suggestions, expires_at=expires_at)
+            return suggestions
+    return None
+
+def get_autocomplete_cache_stats():
+    return _autocomplete_cache.stats()
+
 # Function for Google Places API call (without Streamlit dependencies)
-def get_google_places_suggestions_backend(query, api_key, types='locality'):
+async def get_google_places_suggestions_backend(query, api_key, types='locality'):
     if not query or not api_key:
         return []
-    url = "https://places.googleapis.com/v1/places:autocomplete"
+    types_list = [types] if isinstance(types, str) else list(types)
+    types_key = tuple(types_list)
+    normalized_query = _normalize(query)
+    if normalized_query:
+        cached = _cached_suggestions(types_key, normalized_query)
+        if cached is not None:
+            return list(cached)
+
+    url = f"{GOOGLE_PLACES_BASE_URL}/v1/places:autocomplete"
     headers = {"Content-Type": "application/json", 'X-Goog-Api-Key': api_key}
     data_payload = {
         "input": query,
-        "includedPrimaryTypes": [types] if isinstance(types, str) else types,
+        "includedPrimaryTypes": types_list,
     }
     try:
-        response = requests.post(url, headers=headers, json=data_payload)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+        response = await http_client.request("POST", url, upstream="places", headers=headers, json=data_payload)
+        response.raise_for_status() # Raise HTTPStatusError for bad responses (4xx or 5xx)
         
         # Extract mainText and secondaryText as desired
         suggestions = []
@@ -23,7 +73,9 @@ def get_google_places_suggestions_backend(query, api_key, types='locality'):
                 main_text = item['placePrediction']['structuredFormat']['mainText']['text']
                 secondary_text = item['placePrediction']['structuredFormat']['secondaryText']['text']
                 suggestions.append(f"{main_text}, {secondary_text}")
-        return suggestions
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, upstream_scheduler.UpstreamUnavailable) as e:
         print(f"Google Places API Error: {e}") # Log error, don't use st.error
-        return []
\ No newline at end of file
+        return [] # Errors are not cached; an open circuit or exhausted quota returns immediately
+    if normalized_query:
+        _autocomplete_cache.set((types_key, normalized_query), suggestions)
+    return list(suggestions)
@@ -0,0 +1,83 @@
+# utils/http_client.py
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from utils import metrics, upstream_scheduler
+
+# Shared upstream client settings
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "50"))
+UPSTREAM_MAX_CONNECTIONS_PER_HOST = int(os.getenv("UPSTREAM_MAX_CONNECTIONS_PER_HOST", "100"))
+UPSTREAM_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_SECONDS", "30"))
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_SECONDS", "5"))
+UPSTREAM_READ_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_READ_TIMEOUT_SECONDS", "10"))
+UPSTREAM_POOL_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_POOL_TIMEOUT_SECONDS", "10"))
+
+_client = None
+_host_semaphores = {}
+
+def get_client():
+    """Returns the process-wide AsyncClient, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(
+                connect=UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+                read=UPSTREAM_READ_TIMEOUT_SECONDS,
+                write=UPSTREAM_READ_TIMEOUT_SECONDS,
+                pool=UPSTREAM_POOL_TIMEOUT_SECONDS,
+            ),
+        )
+    return _client
+
+async def close_client():
+    """Closes the shared client and its keep-alive connections (call on application shutdown)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _host_semaphores.clear()
+
+def _host_semaphore(url):
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(UPSTREAM_MAX_CONNECTIONS_PER_HOST)
+    return semaphore
+
+async def request(method, url, upstream="other", **kwargs):
+    """
+    Sends a request through the shared client, limiting concurrent requests per upstream host.
+    Known upstreams (e.g. 'onecall', 'places') go through the upstream scheduler, so this may retry and may raise
+    upstream_scheduler.UpstreamUnavailable. Latency and in-flight counts are recorded under the `upstream` label.
+    """
+    return await upstream_scheduler.call(upstream, lambda: _send(method, url, upstream, **kwargs))
+
+async def _send(method, url, upstream, **kwargs):
+    async with _host_semaphore(url):
+        metrics.UPSTREAM_IN_FLIGHT.inc(upstream=upstream)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await get_client().request(method, url, **kwargs)
+            outcome = f"{response.status_code // 100}xx"
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.UPSTREAM_IN_FLIGHT.dec(upstream=upstream)
+            metrics.UPSTREAM_REQUEST_SECONDS.observe(elapsed, upstream=upstream, outcome=outcome)
+            metrics.add_request_time("upstream", elapsed)
+
+async def get_json(url, params=None, headers=None, upstream="other"):
+    """GETs a URL and returns the decoded JSON body, whatever the status code."""
+    response = await request("GET", url, upstream=upstream, params=params, headers=headers)
+    return response.json()
@@ -0,0 +1,89 @@
+# utils/lru_cache.py
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache with per-entry expiry.
+    Bounded by entry count and, optionally, by the total of the `size` values passed to set().
+    """
+    def __init__(self, max_entries, max_bytes=None, default_ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict() # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = self.get_with_expiry(key)
+        return default if entry is None else entry[0]
+
+    def get_with_expiry(self, key):
+        """Returns (value, expires_at) for a live entry, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove_locked(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, expires_at
+
+    def set(self, key, value, ttl=None, expires_at=None, size=0):
+        """Stores a value. Expiry is `expires_at` (epoch seconds) if given, else now + ttl (or default_ttl)."""
+        if expires_at is None:
+            ttl = self.default_ttl if ttl is None else ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+        if self.max_bytes is not None and size > self.max_bytes:
+            return # Never cache a single value larger than the whole budget
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove_locked(oldest_key)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove_locked(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,196 @@
+# utils/metrics.py
+"""
+Minimal in-process metrics (counters, gauges, histograms) rendered in the Prometheus text format.
+Recording is a dict lookup plus a lock per sample, cheap enough to leave on in production.
+"""
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_stats_collectors = []
+
+# Per-request time accumulators ({'db': seconds, 'upstream': seconds}), set by MetricsMiddleware
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Gauge(Counter):
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-1]!r}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class _Timer:
+    """Context manager observing elapsed seconds into a histogram (and, optionally, the current request's timings)."""
+    def __init__(self, histogram, labels, request_bucket=None):
+        self.histogram, self.labels, self.request_bucket = histogram, labels, request_bucket
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed, **self.labels)
+        if self.request_bucket:
+            add_request_time(self.request_bucket, elapsed)
+
+def timed(histogram, request_bucket=None, **labels):
+    """Decorator timing a sync function into `histogram`, labelled function=<name> plus any fixed labels."""
+    def decorator(fn):
+        fn_labels = {"function": fn.__name__, **labels}
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timer(histogram, fn_labels, request_bucket):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_request_time(bucket, seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[bucket] = timings.get(bucket, 0.0) + seconds
+
+def register_stats(name, help_text, fn):
+    """Exports a function returning {stat: number} as a gauge `name{stat="..."}`, read at scrape time."""
+    _stats_collectors.append((name, help_text, fn))
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, help_text, fn in _stats_collectors:
+        try:
+            stats = fn()
+        except Exception as e: # A failing collector shouldn't break the whole scrape
+            print(f"Metrics collector {name} failed: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for stat, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{name}{{stat="{stat}"}} {_format_value(value)}')
+    return "\n".join(lines) + "\n"
+
+# Shared metrics
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency by route.", ("route", "method", "status"))
+UPSTREAM_REQUEST_SECONDS = Histogram("upstream_request_duration_seconds", "Upstream API call latency.", ("upstream", "outcome"))
+UPSTREAM_IN_FLIGHT = Gauge("upstream_requests_in_flight", "Upstream API calls currently in flight.", ("upstream",))
+DB_CALL_SECONDS = Histogram("db_call_duration_seconds", "db_cache function latency.", ("function",))
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled database connection.")
+UPSTREAM_REJECTIONS = Counter("upstream_rejections_total", "Upstream calls refused by the scheduler, by reason.", ("api", "reason"))
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Upstream call retries after a transport error, 429 or 5xx.", ("upstream",))
+WEATHER_CACHE_LOOKUPS = Counter("weather_cache_lookups_total", "Current-weather cache lookups by result.", ("result",))
+GAZETTEER_LOOKUPS = Counter("gazetteer_lookups_total", "Offline gazetteer lookups (city, zip, suggest) by result.", ("kind", "result"))
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording per-route latency. When timing_headers is enabled, or the request sends
+    `X-Debug-Timing: 1`, the response carries a Server-Timing header with app, db and upstream time.
+    """
+    def __init__(self, app, timing_headers=False):
+        self.app = app
+        self.timing_headers = timing_headers
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        timings = {}
+        token = _request_timings.set(timings)
+        debug = self.timing_headers or (b"x-debug-timing", b"1") in scope.get("headers", [])
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if debug:
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    server_timing = f"app;dur={elapsed_ms:.1f}, db;dur={timings.get('db', 0) * 1000:.1f}, upstream;dur={timings.get('upstream', 0) * 1000:.1f}"
+                    message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", server_timing.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=scope["method"], status=status)
+            _request_timings.reset(token)
@@ -0,0 +1,38 @@
+# utils/openweather.py
+import os
+
+from utils import http_client
+
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org")
+
+async def geocode_city(city, api_key):
+    """Resolves a city name via the geocoding API. Returns the raw JSON list (empty if not found)."""
+    return await http_client.get_json(
+        f"{OPENWEATHER_BASE_URL}/geo/1.0/direct",
+        upstream="geo",
+        params={"q": city, "limit": 1, "appid": api_key},
+    )
+
+async def geocode_zip(zip_code, country_code, api_key):
+    """Resolves a zip code via the 2.5 weather endpoint. Returns the raw JSON dict ('cod' is 200 on success)."""
+    return await http_client.get_json(
+        f"{OPENWEATHER_BASE_URL}/data/2.5/weather",
+        upstream="zip",
+        params={"zip": f"{zip_code},{country_code}", "appid": api_key},
+    )
+
+async def fetch_onecall(lat, lon, api_key):
+    """Fetches current + daily weather from the OneCall 3.0 API. Returns the raw JSON dict."""
+    return await http_client.get_json(
+        f"{OPENWEATHER_BASE_URL}/data/3.0/onecall",
+        upstream="onecall",
+        params={"lat": lat, "lon": lon, "exclude": "minutely,hourly,alerts", "appid": api_key, "units": "metric"},
+    )
+
+async def fetch_timemachine(lat, lon, dt, api_key):
+    """Fetches historical weather for the timestamp `dt` from the OneCall 3.0 time machine API. Returns the raw JSON dict."""
+    return await http_client.get_json(
+        f"{OPENWEATHER_BASE_URL}/data/3.0/onecall/timemachine",
+        upstream="timemachine",
+        params={"lat": lat, "lon": lon, "dt": dt, "appid": api_key, "units": "metric"},
+    )
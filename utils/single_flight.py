@@ -0,0 +1,39 @@
+# utils/single_flight.py
+import asyncio
+
+# key -> Future shared by every caller currently waiting on that key
+_inflight = {}
+
+async def run(key, fn):
+    """
+    Runs the coroutine function `fn` once per key at a time.
+    Concurrent callers with the same key await the first caller's result (or exception)
+    instead of starting their own call.
+    """
+    future = _inflight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await fn()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception() # Mark as retrieved so a leader without followers doesn't log a warning
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+def is_inflight(key):
+    return key in _inflight
+
+def inflight_count():
+    """Number of keys with a call currently in flight."""
+    return len(_inflight)
@@ -0,0 +1,247 @@
+# utils/upstream_scheduler.py
+"""
+Admission control for upstream API calls: per-API token buckets, optional quotas shared across workers
+(leased in blocks from a store such as db_cache.lease_upstream_quota), interactive-before-background priority,
+circuit breakers and retries with jittered backoff.
+
+Calls that can't be admitted, or that still fail after retries, raise UpstreamUnavailable quickly instead of
+queueing behind a degraded upstream.
+"""
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import time
+
+import httpx
+
+from utils import metrics
+
+INTERACTIVE, BACKGROUND = "interactive", "background"
+
+# Which API's quota each upstream label draws from
+API_FOR_UPSTREAM = {"geo": "openweather", "zip": "openweather", "onecall": "openweather", "timemachine": "openweather", "places": "places"}
+
+UPSTREAM_QUOTA_LEASE_SIZE = int(os.getenv("UPSTREAM_QUOTA_LEASE_SIZE", "10")) # Calls reserved per shared-quota round trip
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_SECONDS", "2")) # Max wait for a token (interactive)
+UPSTREAM_BACKGROUND_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_BACKGROUND_QUEUE_TIMEOUT_SECONDS", "60"))
+UPSTREAM_INTERACTIVE_RESERVE = float(os.getenv("UPSTREAM_INTERACTIVE_RESERVE", "0.25")) # Fraction of the burst background calls leave free
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_SECONDS = float(os.getenv("UPSTREAM_RETRY_BASE_SECONDS", "0.2"))
+UPSTREAM_RETRY_MAX_SECONDS = float(os.getenv("UPSTREAM_RETRY_MAX_SECONDS", "2"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")) # Consecutive failures before opening
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30")) # Open time before a single probe call is let through
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+_quota_store = None
+
+class UpstreamUnavailable(Exception):
+    """An upstream call was rejected (rate limit, quota, open circuit) or failed after retries."""
+    def __init__(self, api, reason, retry_after=None):
+        super().__init__(f"{api} unavailable: {reason}")
+        self.api = api
+        self.reason = reason
+        self.retry_after = retry_after
+
+@contextlib.contextmanager
+def priority(level):
+    """Runs upstream calls made inside the block (in this task) at the given priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def set_quota_store(lease_fn):
+    """
+    Enables cross-worker quotas. lease_fn(api, period, window_start, amount, limit) is a blocking call that reserves
+    up to `amount` calls in the shared window and returns how many were granted (0 when the window is used up).
+    """
+    global _quota_store
+    _quota_store = lease_fn
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; while open, lets one probe through every `reset_seconds`."""
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.open_until = None # None while closed
+
+    def allow(self):
+        if self.open_until is None:
+            return True
+        now = time.monotonic()
+        if now < self.open_until:
+            return False
+        self.open_until = now + self.reset_seconds # This caller is the probe; others keep failing fast
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.open_until is not None or self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.reset_seconds
+
+    def retry_after(self):
+        return max(0.0, self.open_until - time.monotonic()) if self.open_until is not None else 0.0
+
+class _SharedQuota:
+    """This worker's leased share of a fixed-window quota (per minute or per day) kept in the quota store."""
+    def __init__(self, api, period, window_seconds, limit):
+        self.api, self.period, self.window_seconds, self.limit = api, period, window_seconds, limit
+        self.window_start = None
+        self.remaining = 0
+        self.exhausted = False
+        self._lock = asyncio.Lock()
+
+    async def take(self):
+        """Returns None if a call may proceed, else seconds until the window resets."""
+        if self.limit <= 0 or _quota_store is None:
+            return None
+        async with self._lock:
+            now = int(time.time())
+            window_start = now - now % self.window_seconds
+            if window_start != self.window_start:
+                # Unused calls leased in the previous window are forfeited (at most a lease per worker).
+                self.window_start, self.remaining, self.exhausted = window_start, 0, False
+            if self.remaining == 0 and not self.exhausted:
+                try:
+                    self.remaining = await asyncio.to_thread(
+                        _quota_store, self.api, self.period, window_start, UPSTREAM_QUOTA_LEASE_SIZE, self.limit
+                    )
+                except Exception as e:
+                    print(f"Upstream quota lease for {self.api} failed, allowing call: {e!r}") # Fail open on store errors
+                    return None
+                self.exhausted = self.remaining == 0
+            if self.remaining == 0:
+                return window_start + self.window_seconds - now
+            self.remaining -= 1
+            return None
+
+class ApiLimiter:
+    """Token bucket (per worker) plus shared quotas and a circuit breaker for one upstream API."""
+    def __init__(self, api, rate_per_minute, burst, per_minute_limit, daily_limit):
+        self.api = api
+        self.rate = rate_per_minute / 60 # Tokens per second; 0 disables local rate limiting
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.interactive_waiting = 0
+        self.quotas = [_SharedQuota(api, "minute", 60, per_minute_limit), _SharedQuota(api, "day", 86400, daily_limit)]
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, level):
+        """Waits for a token (interactive callers first) and a shared-quota slot, or raises UpstreamUnavailable."""
+        if self.rate > 0:
+            loop = asyncio.get_running_loop()
+            timeout = UPSTREAM_QUEUE_TIMEOUT_SECONDS if level == INTERACTIVE else UPSTREAM_BACKGROUND_QUEUE_TIMEOUT_SECONDS
+            deadline = loop.time() + timeout
+            # Background calls leave part of the burst for interactive traffic and yield to waiting interactive calls.
+            needed = 1.0 if level == INTERACTIVE else min(self.burst, 1.0 + UPSTREAM_INTERACTIVE_RESERVE * self.burst)
+            while True:
+                self._refill()
+                if self.tokens >= needed and (level == INTERACTIVE or self.interactive_waiting == 0):
+                    self.tokens -= 1
+                    break
+                wait = max((needed - self.tokens) / self.rate, 0.01)
+                if loop.time() + wait > deadline:
+                    metrics.UPSTREAM_REJECTIONS.inc(api=self.api, reason="rate_limited")
+                    raise UpstreamUnavailable(self.api, "rate limited", retry_after=wait)
+                if level == INTERACTIVE:
+                    self.interactive_waiting += 1
+                try:
+                    await asyncio.sleep(wait)
+                finally:
+                    if level == INTERACTIVE:
+                        self.interactive_waiting -= 1
+        for quota in self.quotas:
+            retry_after = await quota.take()
+            if retry_after is not None:
+                metrics.UPSTREAM_REJECTIONS.inc(api=self.api, reason=f"{quota.period}_quota")
+                raise UpstreamUnavailable(self.api, f"{quota.period} quota exhausted", retry_after=retry_after)
+
+def _limiter_from_env(api, prefix):
+    rate = float(os.getenv(f"{prefix}_RATE_PER_MINUTE", "0")) # Per worker; 0 = no local rate limit
+    return ApiLimiter(
+        api,
+        rate_per_minute=rate,
+        burst=float(os.getenv(f"{prefix}_BURST", str(max(1.0, rate / 6)))), # Default: 10 seconds' worth
+        per_minute_limit=int(os.getenv(f"{prefix}_SHARED_PER_MINUTE_LIMIT", "0")), # Across all workers; 0 = no shared limit
+        daily_limit=int(os.getenv(f"{prefix}_DAILY_LIMIT", "0")),
+    )
+
+_limiters = {
+    "openweather": _limiter_from_env("openweather", "OPENWEATHER"),
+    "places": _limiter_from_env("places", "GOOGLE_PLACES"),
+}
+
+def get_limiter(api):
+    return _limiters[api]
+
+def get_stats():
+    """Per-API token, waiting and circuit state, for the metrics endpoint."""
+    stats = {}
+    for api, limiter in _limiters.items():
+        limiter._refill()
+        stats[f"{api}_tokens"] = round(limiter.tokens, 2)
+        stats[f"{api}_interactive_waiting"] = limiter.interactive_waiting
+        stats[f"{api}_circuit_open"] = int(limiter.breaker.open_until is not None)
+    return stats
+
+def _backoff_seconds(attempt, response):
+    if response is not None and response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            retry_after = None
+        if retry_after is not None and retry_after <= UPSTREAM_RETRY_MAX_SECONDS:
+            return retry_after
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX_SECONDS, UPSTREAM_RETRY_BASE_SECONDS * 2 ** attempt)) # Full jitter
+
+async def call(upstream, send):
+    """
+    Runs `send` (a coroutine function returning an httpx.Response) under the limits of the API `upstream` belongs to.
+    Transport errors, 429 and 5xx responses are retried with jittered backoff, each attempt taking a token;
+    if they persist, UpstreamUnavailable is raised. Other responses are returned as-is.
+    """
+    api = API_FOR_UPSTREAM.get(upstream)
+    if api is None:
+        return await send()
+    limiter = _limiters[api]
+    level = _priority.get()
+    attempt = 0
+    while True:
+        if not limiter.breaker.allow():
+            metrics.UPSTREAM_REJECTIONS.inc(api=api, reason="circuit_open")
+            raise UpstreamUnavailable(api, "circuit open", retry_after=limiter.breaker.retry_after())
+        await limiter.acquire(level)
+        response = None
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            failure = repr(e)
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                limiter.breaker.record_success()
+                return response
+            failure = f"HTTP {response.status_code}"
+        limiter.breaker.record_failure()
+        if attempt >= UPSTREAM_RETRIES:
+            raise UpstreamUnavailable(api, f"{upstream} failed after {attempt + 1} attempts ({failure})",
+                                      retry_after=limiter.breaker.retry_after() or None)
+        delay = _backoff_seconds(attempt, response)
+        attempt += 1
+        metrics.UPSTREAM_RETRIES.inc(upstream=upstream)
+        await asyncio.sleep(delay)